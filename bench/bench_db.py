@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+بنچمارک تأخیر کوئری‌های دیتابیس: کد و اسکیمای قبلی (اتصال جدید برای هر کوئری،
+موشک‌ها با کلید نام و مرتب‌سازی CASE) در برابر اتصال‌های دائمی WAL و missile_id (بعد)
+
+اجرا:
+    python bench/bench_db.py --users 100000 --ops 5000
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix='warzone-bench-')
+
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+os.environ['DB_PATH'] = os.path.join(TMP_DIR, 'main.db')
+sys.path.insert(0, ROOT)
+
+from main import Database, MISSILE_NAMES  # noqa: E402
+
+
+# === پیاده‌سازی قدیمی (یک اتصال برای هر کوئری) ===
+class LegacyDatabase:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def get_connection(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get_user(self, user_id):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        user = cursor.fetchone()
+        conn.close()
+        return dict(user) if user else None
+
+    def get_user_missiles(self, user_id):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT missile_name, quantity FROM user_missiles 
+        WHERE user_id = ? AND quantity > 0
+        ORDER BY 
+            CASE missile_name
+                WHEN 'شبح (Ghost)' THEN 1
+                WHEN 'رعد (Thunder)' THEN 2
+                WHEN 'تندر (Boomer)' THEN 3
+                WHEN 'هاوک (Hawk)' THEN 4
+                WHEN 'پاتریوت (Patriot)' THEN 5
+                WHEN 'شهاب (Meteor)' THEN 6
+                WHEN 'سیل (Tsunami)' THEN 7
+                WHEN 'توفان (Storm)' THEN 8
+                WHEN 'تایفون (Typhoon)' THEN 9
+                WHEN 'آپوکالیپس (Apocalypse)' THEN 10
+                ELSE 11
+            END
+        ''', (user_id,))
+        missiles = cursor.fetchall()
+        conn.close()
+        return [dict(m) for m in missiles]
+
+    def update_user_coins(self, user_id, amount):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET zone_coin = zone_coin + ? WHERE user_id = ?', (amount, user_id))
+        conn.commit()
+        conn.close()
+
+
+def populate(db_path, users):
+    """ساخت دیتابیس با users کاربر و موجودی اولیه موشک"""
+    database = Database(db_path)
+    with database.transaction() as cursor:
+        cursor.executemany(
+            'INSERT INTO users (user_id, username, full_name, zone_coin) VALUES (?, ?, ?, ?)',
+            ((uid, f'user{uid}', f'User {uid}', random.randint(0, 100000)) for uid in range(1, users + 1))
+        )
+        cursor.executemany(
+            'INSERT INTO user_missiles (user_id, missile_id, quantity) VALUES (?, ?, ?)',
+            ((uid, missile_id, 3) for uid in range(1, users + 1) for missile_id in (1, 2))
+        )
+    database.close()
+
+
+def legacy_schema(db_path):
+    """برگرداندن user_missiles به اسکیمای قبلی (کلید نام موشک) و حالت پیش‌فرض sqlite"""
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    rows = conn.execute('SELECT user_id, missile_id, quantity FROM user_missiles').fetchall()
+    conn.execute('DROP TABLE user_missiles')
+    conn.execute('''
+    CREATE TABLE user_missiles (
+        user_id INTEGER,
+        missile_name TEXT,
+        quantity INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, missile_name),
+        FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+    )
+    ''')
+    conn.executemany('INSERT INTO user_missiles VALUES (?, ?, ?)',
+                     ((user_id, MISSILE_NAMES[missile_id], quantity) for user_id, missile_id, quantity in rows))
+    conn.commit()
+    conn.close()
+
+
+def measure(func, ids):
+    samples = []
+    for uid in ids:
+        start = time.perf_counter()
+        func(uid)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        'mean_us': round(statistics.fmean(samples), 1),
+        'p50_us': round(samples[len(samples) // 2], 1),
+        'p99_us': round(samples[int(len(samples) * 0.99)], 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--ops', type=int, default=5000)
+    parser.add_argument('--json', help='مسیر ذخیره نتیجه به صورت JSON')
+    args = parser.parse_args()
+
+    legacy_path = os.path.join(TMP_DIR, 'legacy.db')
+    pooled_path = os.path.join(TMP_DIR, 'pooled.db')
+
+    # دیتابیس قبل: حالت پیش‌فرض sqlite (journal=DELETE, synchronous=FULL) و اسکیمای قبلی موشک‌ها
+    populate(legacy_path, args.users)
+    legacy_schema(legacy_path)
+    populate(pooled_path, args.users)
+
+    legacy = LegacyDatabase(legacy_path)
+    pooled = Database(pooled_path)
+    # مقایسه اتصال‌ها، نه کش کاربران: کش با ظرفیت صفر هیچ ردیفی نگه نمی‌دارد
+    pooled.cache.max_size = 0
+    ids = [random.randint(1, args.users) for _ in range(args.ops)]
+
+    results = {}
+    for label, database in (('before', legacy), ('after', pooled)):
+        results[label] = {
+            'get_user': measure(database.get_user, ids),
+            'get_user_missiles': measure(database.get_user_missiles, ids),
+            'update_user_coins': measure(lambda uid: database.update_user_coins(uid, 1), ids)
+        }
+    pooled.close()
+
+    print(f"users={args.users} ops={args.ops} sqlite={sqlite3.sqlite_version}")
+    print(f"{'query':<20}{'before p50':>12}{'after p50':>12}{'before p99':>12}{'after p99':>12}{'speedup':>10}")
+    for query in results['before']:
+        before, after = results['before'][query], results['after'][query]
+        print(f"{query:<20}{before['p50_us']:>10}us{after['p50_us']:>10}us"
+              f"{before['p99_us']:>10}us{after['p99_us']:>10}us{before['mean_us'] / after['mean_us']:>9.1f}x")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'users': args.users, 'ops': args.ops, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
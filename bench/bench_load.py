@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+تست بار سرتاسری: dp واقعی main.py با یک session جعلی (کاملاً آفلاین) اجرا می‌شود و
+آپدیت‌های مصنوعی N کاربر با نرخ هدف از dp.feed_update عبور می‌کنند.
+خروجی: تأخیر p50/p95/p99 هر سناریو، آپدیت در ثانیه و سهم زمان دیتابیس.
+
+اجرا:
+    python bench/bench_load.py --users 1000 --rate 500 --duration 20 --json load.json
+
+محدودیت نرخ کاربران (THROTTLE_*) در بنچمارک غیرفعال است تا زمان هندلرها اندازه‌گیری شود؛
+با --throttle همان محدودیت‌های تنظیم‌شده اعمال و تعداد آپدیت‌های ردشده گزارش می‌شود.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix='warzone-load-')
+
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+os.environ['DB_PATH'] = os.path.join(TMP_DIR, 'main.db')
+os.environ['ADMIN_IDS'] = ''
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+from aiogram import methods  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, Update, User  # noqa: E402
+
+# سناریو -> وزن در ترکیب بار
+SCENARIOS = {
+    'start': 5,
+    'profile': 25,
+    'attack': 15,
+    'buy': 20,
+    'box': 15,
+    'miner_claim': 20
+}
+
+# زمان انتظار دیتابیس برای آپدیت جاری
+db_wait = contextvars.ContextVar('db_wait', default=None)
+
+
+class FakeSession(BaseSession):
+    """session آفلاین: هر متد Bot API بدون شبکه پاسخ موفق می‌گیرد"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        if isinstance(method, (methods.SendMessage, methods.EditMessageText)):
+            chat_id = getattr(method, 'chat_id', None) or 1
+            return Message(message_id=1, date=datetime.now(), chat=Chat(id=chat_id, type='private'), text=method.text)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class UpdateFactory:
+    def __init__(self, users):
+        self.users = users
+        self.update_id = 0
+
+    def next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, user_id, text):
+        user = User(id=user_id, is_bot=False, first_name=f'load{user_id}')
+        chat = Chat(id=user_id, type='private')
+        update_id = self.next_id()
+        return Update(update_id=update_id, message=Message(
+            message_id=update_id, date=datetime.now(), chat=chat, from_user=user, text=text
+        ))
+
+    def callback(self, user_id, data):
+        user = User(id=user_id, is_bot=False, first_name=f'load{user_id}')
+        chat = Chat(id=user_id, type='private')
+        update_id = self.next_id()
+        message = Message(message_id=update_id, date=datetime.now(), chat=chat, from_user=user, text='x')
+        return Update(update_id=update_id, callback_query=CallbackQuery(
+            id=str(update_id), from_user=user, chat_instance='load', message=message, data=data
+        ))
+
+    def build(self, scenario):
+        user_id = random.randint(1, self.users)
+        if scenario == 'start':
+            return self.message(user_id, '/start')
+        if scenario == 'profile':
+            return self.message(user_id, '👤 پروفایل')
+        if scenario == 'attack':
+            target_id = random.randint(1, self.users - 1)
+            target_id += target_id >= user_id
+            return self.callback(user_id, main.cb_data('quick_attack', 'simple', target_id))
+        if scenario == 'buy':
+            return self.callback(user_id, main.cb_data('buy', 'شبح (Ghost)'))
+        if scenario == 'box':
+            return self.callback(user_id, main.cb_data('box', 'coin'))
+        if scenario == 'miner_claim':
+            return self.callback(user_id, main.cb_data('claim_miner'))
+        raise ValueError(scenario)
+
+
+def instrument_db():
+    """اندازه‌گیری زمان انتظار برای دیتابیس (executor و group commit) به ازای هر آپدیت"""
+    run, add = main.adb.run, main.writer.add
+
+    async def timed_run(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await run(*args, **kwargs)
+        finally:
+            acc = db_wait.get()
+            if acc is not None:
+                acc[0] += time.perf_counter() - start
+
+    async def timed_add(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await add(*args, **kwargs)
+        finally:
+            acc = db_wait.get()
+            if acc is not None:
+                acc[0] += time.perf_counter() - start
+
+    main.adb.run = timed_run
+    main.writer.add = timed_add
+
+
+def instrument_throttle(enabled):
+    """شمارش آپدیت‌های ردشده توسط throttle (و غیرفعال کردن آن در حالت پیش‌فرض)"""
+    if not enabled:
+        main.throttle.limits = {name: (1e9, 1e9) for name in main.throttle.limits}
+    allow = main.throttle.allow
+    rejected = [0]
+
+    def counted_allow(*args, **kwargs):
+        allowed = allow(*args, **kwargs)
+        rejected[0] += not allowed
+        return allowed
+
+    main.throttle.allow = counted_allow
+    return rejected
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def pick(q):
+        return round(samples[min(int(len(samples) * q), len(samples) - 1)] * 1000, 3)
+
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': pick(0.50),
+        'p95_ms': pick(0.95),
+        'p99_ms': pick(0.99),
+        'max_ms': round(samples[-1] * 1000, 3)
+    }
+
+
+async def run(args):
+    session = FakeSession()
+    main.bot.session = session
+    instrument_db()
+    throttled = instrument_throttle(args.throttle)
+    await main.dp.emit_startup(bot=main.bot)
+
+    factory = UpdateFactory(args.users)
+    latencies = {name: [] for name in SCENARIOS}
+    totals = {'latency': 0.0, 'db': 0.0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    async def handle(scenario, update):
+        acc = [0.0]
+        db_wait.set(acc)
+        totals['in_flight'] += 1
+        totals['max_in_flight'] = max(totals['max_in_flight'], totals['in_flight'])
+        start = time.perf_counter()
+        try:
+            await main.dp.feed_update(main.bot, update)
+        except Exception:
+            totals['errors'] += 1
+        elapsed = time.perf_counter() - start
+        totals['in_flight'] -= 1
+        latencies[scenario].append(elapsed)
+        totals['latency'] += elapsed
+        totals['db'] += acc[0]
+
+    # ثبت‌نام همه کاربران قبل از شروع اندازه‌گیری
+    for user_id in range(1, args.users + 1):
+        await main.dp.feed_update(main.bot, factory.message(user_id, '/start'))
+    throttled[0] = 0
+
+    names, weights = list(SCENARIOS), list(SCENARIOS.values())
+    total_updates = int(args.rate * args.duration)
+    tasks = []
+    started = time.perf_counter()
+    for i in range(total_updates):
+        delay = started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        scenario = random.choices(names, weights)[0]
+        tasks.append(asyncio.create_task(handle(scenario, factory.build(scenario))))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    await main.dp.emit_shutdown(bot=main.bot)
+
+    all_latencies = [sample for samples in latencies.values() for sample in samples]
+    return {
+        'config': {
+            'users': args.users,
+            'target_rate': args.rate,
+            'duration_s': args.duration,
+            'seed': args.seed,
+            'throttle': args.throttle
+        },
+        'updates': total_updates,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(total_updates / elapsed, 1),
+        'errors': totals['errors'],
+        'throttled': throttled[0],
+        'max_in_flight': totals['max_in_flight'],
+        'api_requests': session.requests,
+        'db_time_share': round(totals['db'] / totals['latency'], 3) if totals['latency'] else 0,
+        'latency': percentiles(all_latencies),
+        'scenarios': {name: percentiles(samples) for name, samples in latencies.items()},
+        'writer': main.writer.stats()
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=500, help='آپدیت در ثانیه')
+    parser.add_argument('--duration', type=float, default=10, help='ثانیه')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--throttle', action='store_true', help='اعمال محدودیت نرخ کاربران (THROTTLE_*)')
+    parser.add_argument('--json', help='مسیر ذخیره نتیجه به صورت JSON')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    result = asyncio.run(run(args))
+
+    print(f"users={args.users} target={args.rate:g}/s achieved={result['updates_per_s']}/s "
+          f"updates={result['updates']} errors={result['errors']} throttled={result['throttled']} "
+          f"max_in_flight={result['max_in_flight']} db_share={result['db_time_share'] * 100:.1f}%")
+    print(f"{'scenario':<14}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, stats in list(result['scenarios'].items()) + [('all', result['latency'])]:
+        if stats:
+            print(f"{name:<14}{stats['count']:>8}{stats['p50_ms']:>8}ms{stats['p95_ms']:>8}ms{stats['p99_ms']:>8}ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
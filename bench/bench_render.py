@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+بنچمارک هزینه رندر هندلرها: هر هندلر مستقیم (بدون مسیریابی dispatcher) با یک
+session جعلی بدون شبکه اجرا می‌شود؛ زمان شامل خواندن کش کاربر، متن، کیبورد و
+ساخت متد ارسال است.
+
+اجرا:
+    python bench/bench_render.py --iterations 2000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix='warzone-bench-')
+
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+os.environ['DB_PATH'] = os.path.join(TMP_DIR, 'main.db')
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+from aiogram import methods  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, User  # noqa: E402
+
+USER_ID = 1000
+
+
+class NullSession(BaseSession):
+    """session بدون شبکه: پیام‌ها فقط ساخته می‌شوند"""
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, (methods.SendMessage, methods.EditMessageText)):
+            return Message(message_id=1, date=datetime.now(), chat=Chat(id=USER_ID, type='private'), text=method.text)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+def make_message(text):
+    user = User(id=USER_ID, is_bot=False, first_name='bench')
+    chat = Chat(id=USER_ID, type='private')
+    return Message(message_id=1, date=datetime.now(), chat=chat, from_user=user, text=text).as_(main.bot)
+
+
+def make_callback(data):
+    user = User(id=USER_ID, is_bot=False, first_name='bench')
+    return CallbackQuery(
+        id='1', from_user=user, chat_instance='bench', message=make_message('x'), data=data
+    ).as_(main.bot)
+
+
+def make_state():
+    key = StorageKey(bot_id=main.bot.id, chat_id=USER_ID, user_id=USER_ID)
+    return FSMContext(storage=main.dp.storage, key=key)
+
+
+# نام صفحه -> (نام هندلر، سازنده آرگومان‌ها)
+SCREENS = {
+    'start': ('cmd_start', lambda: (make_message('/start'),)),
+    'help': ('cmd_help', lambda: (make_message('📖 راهنما'),)),
+    'attack_menu': ('cmd_attack', lambda: (make_message('⚔️ حمله'), make_state())),
+    'market': ('cmd_market', lambda: (make_message('🏪 بازار'),)),
+    'market_special': ('cmd_market_special', lambda: (make_callback('market_special'),)),
+    'boxes': ('cmd_boxes', lambda: (make_message('🎁 باکس'),)),
+    'miner': ('cmd_miner', lambda: (make_message('⛏️ ماینر'),)),
+    'defense': ('cmd_defense', lambda: (make_message('🏰 دفاع'),)),
+    'defense_info': ('cmd_defense_info', lambda: (make_callback('defense_info'),)),
+}
+
+
+async def measure(handler, args, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await handler(*args)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        'mean_us': round(statistics.fmean(samples), 1),
+        'p50_us': round(samples[len(samples) // 2], 1),
+        'p99_us': round(samples[int(len(samples) * 0.99)], 1)
+    }
+
+
+async def run(args):
+    main.bot.session = NullSession()
+    await main.cmd_start(make_message('/start'))
+
+    results = {}
+    for name, (handler_name, factory) in SCREENS.items():
+        handler = getattr(main, handler_name)
+        handler_args = factory()
+        await measure(handler, handler_args, max(args.iterations // 10, 1))
+        results[name] = await measure(handler, handler_args, args.iterations)
+
+    await main.dp.emit_shutdown(bot=main.bot)
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--json', help='مسیر ذخیره نتیجه به صورت JSON')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    print(f"iterations={args.iterations}")
+    print(f"{'screen':<18}{'mean':>10}{'p50':>10}{'p99':>10}")
+    for name, result in results.items():
+        print(f"{name:<18}{result['mean_us']:>8}us{result['p50_us']:>8}us{result['p99_us']:>8}us")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'iterations': args.iterations, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
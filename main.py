@@ -5,12 +5,25 @@ Warzone Telegram Bot - Version 2.0.0
 """
 
 import asyncio
+import base64
+import binascii
+import bisect
+import inspect
+import math
 import sqlite3
 import random
 import time
 import logging
+import functools
+import json
+import secrets
+import signal
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, Any
 import os
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
@@ -21,9 +34,14 @@ from aiogram.types import (
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 import aiohttp
+from aiohttp import web
 
 # === تنظیمات لاگ ===
 logging.basicConfig(
@@ -40,14 +58,180 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(x.strip()) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()]
 PORT = int(os.getenv('PORT', 8080))
 KEEP_ALIVE_URL = os.getenv('KEEP_ALIVE_URL', '')
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()  # polling یا webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', KEEP_ALIVE_URL).rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# اگر تنظیم نشود در هر اجرا یک secret تصادفی ساخته و با setWebhook ثبت می‌شود
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+# آدرس سرور Bot API (خالی = api.telegram.org)؛ برای سرور محلی یا tools/fake_bot_api.py
+BOT_API_URL = os.getenv('BOT_API_URL', '').rstrip('/')
+DB_PATH = os.getenv('DB_PATH', 'app/data/warzone.db')
+DB_WORKERS = int(os.getenv('DB_WORKERS', 4))
+DB_QUEUE_SIZE = int(os.getenv('DB_QUEUE_SIZE', 256))
+DB_CACHE_KB = int(os.getenv('DB_CACHE_KB', 65536))  # 64MB کش صفحات برای هر اتصال
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 268435456))  # 256MB
+DB_STATEMENT_CACHE = int(os.getenv('DB_STATEMENT_CACHE', 256))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 50000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))  # پیام در ثانیه (محدودیت کلی تلگرام ~30)
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+BROADCAST_CHUNK = int(os.getenv('BROADCAST_CHUNK', 200))
+FSM_HOT_SIZE = int(os.getenv('FSM_HOT_SIZE', 10000))
+FSM_TTL = int(os.getenv('FSM_TTL', 86400))  # وضعیت‌های قدیمی‌تر از یک روز منقضی می‌شوند
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', 1.0))
+WRITE_BATCH_DELAY_MS = float(os.getenv('WRITE_BATCH_DELAY_MS', 5))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 500))
+ATTACK_LOG_BUFFER = int(os.getenv('ATTACK_LOG_BUFFER', 10000))
+ATTACK_LOG_BATCH = int(os.getenv('ATTACK_LOG_BATCH', 200))
+ATTACK_LOG_INTERVAL = float(os.getenv('ATTACK_LOG_INTERVAL', 1.0))
+USER_LOCK_SHARDS = int(os.getenv('USER_LOCK_SHARDS', 64))
+# محدودیت نرخ هر کاربر برای هر کلاس عملیات: (توکن در ثانیه، ظرفیت bucket)
+THROTTLE_LIMITS = {
+    'read': (float(os.getenv('THROTTLE_READ_RATE', 2)), float(os.getenv('THROTTLE_READ_BURST', 8))),
+    'mutation': (float(os.getenv('THROTTLE_MUTATION_RATE', 4)), float(os.getenv('THROTTLE_MUTATION_BURST', 10))),
+    'attack': (float(os.getenv('THROTTLE_ATTACK_RATE', 1)), float(os.getenv('THROTTLE_ATTACK_BURST', 3)))
+}
 
 if not BOT_TOKEN:
     raise ValueError("لطفا BOT_TOKEN را در .env تنظیم کنید")
 
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError("BOT_MODE باید polling یا webhook باشد")
+
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise ValueError("برای حالت webhook لطفا WEBHOOK_URL را در .env تنظیم کنید")
+
+# === متریک‌ها (فرمت متنی Prometheus) ===
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """شمارش مشاهدات در bucketهای ثابت؛ تجمعی کردن فقط هنگام خروجی"""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+        self.count = 0
+
+class Metrics:
+    """رجیستری thread-safe شمارنده و هیستوگرام با خروجی /metrics"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.families = {}  # name -> [type, help, {labels: value}, buckets]
+        self.collectors = []
+
+    def describe(self, name: str, kind: str, help_text: str, buckets=None):
+        """buckets فقط برای هیستوگرام‌هایی که واحدشان ثانیه نیست"""
+        buckets = buckets or self.buckets
+        self.families[name] = [kind, help_text, {}, (buckets, [f"{le:g}" for le in buckets] + ['+Inf'])]
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(labels.items())
+        with self.lock:
+            series = self.families[name][2]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(labels.items())
+        with self.lock:
+            _, _, series, (buckets, _) = self.families[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(len(buckets))
+            histogram.counts[bisect.bisect_left(buckets, value)] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def collector(self, func):
+        """ثبت تابعی که هنگام خروجی لیست (name, type, help, value) برمی‌گرداند"""
+        self.collectors.append(func)
+        return func
+
+    async def track(self, name: str, awaitable):
+        """زمان‌سنجی یک هندلر (و شمارش خطاهایش)"""
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        except Exception:
+            self.inc('warzone_handler_errors_total', handler=name)
+            raise
+        finally:
+            self.observe('warzone_handler_seconds', time.perf_counter() - start, handler=name)
+
+    def timed(self, func):
+        """دکوریتور track برای توابع async که هندلر مستقیم نیستند (مثل execute_attack)"""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self.track(func.__name__, func(*args, **kwargs))
+        return wrapper
+
+    @staticmethod
+    def format_labels(key):
+        if not key:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{label}="{escape(value)}"' for label, value in key) + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, series, (_, bucket_labels)) in self.families.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    if kind != 'histogram':
+                        lines.append(f"{name}{self.format_labels(key)} {value}")
+                        continue
+                    cumulative = 0
+                    for le, count in zip(bucket_labels, value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self.format_labels(key + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{self.format_labels(key)} {value.sum:.6f}")
+                    lines.append(f"{name}_count{self.format_labels(key)} {value.count}")
+        for collect in self.collectors:
+            for name, kind, help_text, value in collect():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe('warzone_handler_seconds', 'histogram', 'Handler latency in seconds')
+metrics.describe('warzone_handler_errors_total', 'counter', 'Unhandled exceptions raised by handlers')
+metrics.describe('warzone_db_query_seconds', 'histogram', 'Database method execution time in seconds')
+metrics.describe('warzone_db_wait_seconds', 'histogram', 'Time database calls waited for an executor thread')
+metrics.describe('warzone_db_errors_total', 'counter', 'Database methods that raised')
+metrics.describe('warzone_bot_api_seconds', 'histogram', 'Outbound Bot API request latency in seconds')
+metrics.describe('warzone_bot_api_requests_total', 'counter', 'Outbound Bot API requests')
+metrics.describe('warzone_bot_api_errors_total', 'counter', 'Outbound Bot API requests that failed')
+metrics.describe('warzone_throttled_total', 'counter', 'Updates rejected by the per-user rate limit')
+metrics.describe('warzone_write_batch_size', 'histogram', 'Operations merged into one group commit',
+                 buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+metrics.describe('warzone_write_flush_seconds', 'histogram', 'Group commit transaction time in seconds')
+
+async def bot_api_metrics(make_request, bot, method):
+    """middleware session: شمارش و زمان‌سنجی درخواست‌های خروجی Bot API"""
+    name = method.__api_method__
+    metrics.inc('warzone_bot_api_requests_total', method=name)
+    start = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        metrics.inc('warzone_bot_api_errors_total', method=name, error=type(e).__name__)
+        raise
+    finally:
+        metrics.observe('warzone_bot_api_seconds', time.perf_counter() - start, method=name)
+
+async def handler_metrics(handler, event, data):
+    """middleware پیام‌ها: هیستوگرام تأخیر به نام تابع هندلر"""
+    return await metrics.track(data['handler'].callback.__name__, handler(event, data))
+
 # === راه‌اندازی ربات ===
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode='HTML'))
+bot.session.middleware(bot_api_metrics)
 
 # === States برای FSM ===
 class UserStates(StatesGroup):
@@ -57,241 +241,1648 @@ class UserStates(StatesGroup):
     waiting_for_broadcast = State()
     admin_panel = State()
 
+# === کش کاربران ===
+class UserCache:
+    """کش LRU با TTL برای ردیف کاربران و موجودی موشک‌ها"""
+
+    def __init__(self, max_size: int = 50000, ttl: int = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.users = OrderedDict()
+        self.missiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0  # با هر clear یک واحد زیاد می‌شود
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, store: OrderedDict, user_id: int):
+        with self.lock:
+            entry = store.get(user_id)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    store.move_to_end(user_id)
+                    self.hits += 1
+                    return entry[1]
+                del store[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, store: OrderedDict, user_id: int, value):
+        """نوشتن مقدار تازه (write-through)"""
+        with self.lock:
+            store[user_id] = (time.monotonic() + self.ttl, value)
+            store.move_to_end(user_id)
+            while len(store) > self.max_size:
+                store.popitem(last=False)
+
+    def fill(self, store: OrderedDict, user_id: int, value, generation: int):
+        """
+        پر کردن بعد از miss با مقداری که بعد از دیدن generation خوانده شده؛ اگر نویسنده در این فاصله
+        مقدار تازه‌تری گذاشته یا کل کش را پاک کرده باشد (تغییر گروهی) نادیده گرفته می‌شود
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            entry = store.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                return
+        self.put(store, user_id, value)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.users.clear()
+            self.missiles.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0,
+            'users': len(self.users),
+            'missiles': len(self.missiles)
+        }
+
+# === رنکینگ ===
+class Leaderboard:
+    """
+    رنکینگ درون‌حافظه‌ای بر اساس zone_coin: لیست مرتب سطل‌بندی‌شده به همراه
+    درخت Fenwick روی اندازه سطل‌ها؛ رتبه هر کاربر در O(log n) و top-K در O(K).
+    """
+
+    LOAD = 512
+    KEY_SHIFT = 1 << 53  # آیدی تلگرام حداکثر 52 بیت است
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.coins = {}
+        self.buckets = []
+        self.maxes = []
+        self.tree = []
+
+    def key(self, user_id: int, coins: int):
+        # سکه بیشتر اول، در تساوی آیدی کوچک‌تر اول
+        return -coins * self.KEY_SHIFT + user_id
+
+    def load(self, rows):
+        """ساخت کامل از (user_id, zone_coin) های مرتب‌شده بر اساس رتبه"""
+        with self.lock:
+            self.coins = {}
+            keys = []
+            for user_id, coins in rows:
+                self.coins[user_id] = coins
+                keys.append(self.key(user_id, coins))
+            keys.sort()
+            self.buckets = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+            self.rebuild()
+
+    def rebuild(self):
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        size = len(self.buckets)
+        self.tree = [0] * (size + 1)
+        for i, bucket in enumerate(self.buckets, 1):
+            self.tree[i] += len(bucket)
+            parent = i + (i & -i)
+            if parent <= size:
+                self.tree[parent] += self.tree[i]
+
+    def tree_add(self, index: int, delta: int):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def tree_prefix(self, index: int):
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def insert(self, key: int):
+        if not self.buckets:
+            self.buckets = [[key]]
+            self.rebuild()
+            return
+        i = min(bisect.bisect_left(self.maxes, key), len(self.buckets) - 1)
+        bucket = self.buckets[i]
+        bisect.insort(bucket, key)
+        self.maxes[i] = bucket[-1]
+        if len(bucket) > 2 * self.LOAD:
+            self.buckets[i:i + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self.rebuild()
+        else:
+            self.tree_add(i, 1)
+
+    def remove(self, key: int):
+        i = bisect.bisect_left(self.maxes, key)
+        bucket = self.buckets[i]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if not bucket:
+            del self.buckets[i]
+            self.rebuild()
+        else:
+            self.maxes[i] = bucket[-1]
+            self.tree_add(i, -1)
+
+    def update(self, user_id: int, coins: int):
+        with self.lock:
+            old = self.coins.get(user_id)
+            if old == coins:
+                return
+            if old is not None:
+                self.remove(self.key(user_id, old))
+            self.coins[user_id] = coins
+            self.insert(self.key(user_id, coins))
+
+    def rank(self, user_id: int):
+        """رتبه کاربر (از 1) یا None"""
+        with self.lock:
+            coins = self.coins.get(user_id)
+            if coins is None:
+                return None
+            key = self.key(user_id, coins)
+            i = bisect.bisect_left(self.maxes, key)
+            return self.tree_prefix(i) + bisect.bisect_left(self.buckets[i], key) + 1
+
+    def top(self, limit: int):
+        """آیدی limit کاربر اول"""
+        with self.lock:
+            result = []
+            for bucket in self.buckets:
+                for key in bucket:
+                    if len(result) >= limit:
+                        return result
+                    result.append(key % self.KEY_SHIFT)
+            return result
+
+    def __len__(self):
+        return len(self.coins)
+
 # === کلاس دیتابیس ===
 class Database:
-    def __init__(self, db_path='app/data/warzone.db'):
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    # نسخه اسکیما در PRAGMA user_version
+    SCHEMA_VERSION = 3
+    
+    def __init__(self, db_path=DB_PATH):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
         self.db_path = db_path
+        # یک اتصال نویسنده مشترک + یک اتصال خواننده برای هر thread
+        self.write_lock = threading.Lock()
+        self.local = threading.local()
+        self.readers = []
+        self.writer = self.open_connection()
+        self.cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.leaderboard = Leaderboard()
+        # کاربرانی که تراکنش جاری تغییرشان داده (برای write-through کش)
+        self.touched_users = set()
+        self.touched_missiles = set()
+        self.touched_all = False
         self.init_db()
+        self.load_leaderboard()
+    
+    def open_connection(self):
+        """باز کردن اتصال دائمی با تنظیمات WAL"""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.create_function('miner_pending', 3, miner_pending, deterministic=True)
+        return conn
     
     def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        """اتصال خواننده مخصوص thread فعلی"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.open_connection()
+            self.local.conn = conn
+            self.readers.append(conn)
         return conn
     
+    @contextmanager
+    def transaction(self):
+        """تراکنش نوشتن روی اتصال نویسنده (یک commit برای کل بلوک)"""
+        with self.write_lock:
+            self.touched_users = set()
+            self.touched_missiles = set()
+            self.touched_all = False
+            cursor = self.writer.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+                rows, missiles = self.read_touched(cursor)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            self.publish(rows, missiles)
+    
+    def touch(self, user_id: int, missiles: bool = False):
+        """علامت‌گذاری کاربر تغییر یافته در تراکنش جاری"""
+        self.touched_users.add(user_id)
+        if missiles:
+            self.touched_missiles.add(user_id)
+    
+    def touch_all(self):
+        """تغییر گروهی: کل کش بعد از commit پاک می‌شود"""
+        self.touched_all = True
+    
+    def read_touched(self, cursor):
+        """خواندن ردیف‌های تازه کاربران تغییر یافته قبل از commit"""
+        rows, missiles = [], {}
+        if self.touched_all:
+            return rows, missiles
+        user_ids = list(self.touched_users)
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            cursor.execute(f'SELECT * FROM users WHERE user_id IN ({",".join("?" * len(chunk))})', chunk)
+            rows.extend(dict(row) for row in cursor.fetchall())
+        for user_id in self.touched_missiles:
+            missiles[user_id] = self.query_missiles(cursor, user_id)
+        return rows, missiles
+    
+    def publish(self, rows, missiles):
+        """به‌روزرسانی کش بعد از commit (هنوز داخل قفل نویسنده)"""
+        if self.touched_all:
+            self.cache.clear()
+            self.load_leaderboard()
+            return
+        for row in rows:
+            self.cache.put(self.cache.users, row['user_id'], row)
+            self.leaderboard.update(row['user_id'], row['zone_coin'])
+        for user_id, items in missiles.items():
+            self.cache.put(self.cache.missiles, user_id, items)
+    
+    def load_leaderboard(self):
+        """ساخت رنکینگ از ایندکس idx_users_ranking"""
+        cursor = self.writer.execute('SELECT user_id, zone_coin FROM users ORDER BY zone_coin DESC, user_id')
+        self.leaderboard.load(cursor)
+    
+    def close(self):
+        for conn in self.readers:
+            conn.close()
+        self.readers.clear()
+        self.writer.close()
+    
     def init_db(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # جدول کاربران
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            full_name TEXT,
-            zone_coin INTEGER DEFAULT 1000,
-            zone_gem INTEGER DEFAULT 10,
-            zone_point INTEGER DEFAULT 500,
-            level INTEGER DEFAULT 1,
-            xp INTEGER DEFAULT 0,
-            is_admin BOOLEAN DEFAULT 0,
-            miner_level INTEGER DEFAULT 1,
-            last_miner_claim INTEGER,
-            cyber_tower_level INTEGER DEFAULT 0,
-            defense_missile_level INTEGER DEFAULT 0,
-            defense_electronic_level INTEGER DEFAULT 0,
-            defense_antifighter_level INTEGER DEFAULT 0,
-            total_defense_bonus REAL DEFAULT 0.0,
-            created_at INTEGER DEFAULT (strftime('%s', 'now'))
-        )
-        ''')
-        
-        # جدول موشک‌ها
+        with self.transaction() as cursor:
+            # جدول کاربران
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                full_name TEXT,
+                zone_coin INTEGER DEFAULT 1000,
+                zone_gem INTEGER DEFAULT 10,
+                zone_point INTEGER DEFAULT 500,
+                level INTEGER DEFAULT 1,
+                xp INTEGER DEFAULT 0,
+                is_admin BOOLEAN DEFAULT 0,
+                miner_level INTEGER DEFAULT 1,
+                last_miner_claim INTEGER,
+                cyber_tower_level INTEGER DEFAULT 0,
+                defense_missile_level INTEGER DEFAULT 0,
+                defense_electronic_level INTEGER DEFAULT 0,
+                defense_antifighter_level INTEGER DEFAULT 0,
+                total_defense_bonus REAL DEFAULT 0.0,
+                created_at INTEGER DEFAULT (strftime('%s', 'now'))
+            )
+            ''')
+            
+            # جدول موشک‌ها
+            self.create_user_missiles(cursor)
+            
+            # جدول حمله‌ها
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attacks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                attacker_id INTEGER,
+                target_id INTEGER,
+                attack_type TEXT,
+                damage INTEGER,
+                loot_coins INTEGER,
+                loot_gems INTEGER,
+                timestamp INTEGER DEFAULT (strftime('%s', 'now')),
+                FOREIGN KEY (attacker_id) REFERENCES users(user_id),
+                FOREIGN KEY (target_id) REFERENCES users(user_id)
+            )
+            ''')
+            
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_attacks_attacker ON attacks(attacker_id, timestamp)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_attacks_target ON attacks(target_id, timestamp)')
+            
+            # ایندکس رنکینگ
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_ranking ON users(zone_coin DESC, user_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)')
+            
+            # آمار کلی (با تریگر در همان تراکنش‌های تغییر موجودی به‌روز می‌شود)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS global_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_users INTEGER,
+                total_coins INTEGER,
+                total_gems INTEGER,
+                total_zp INTEGER,
+                total_levels INTEGER,
+                total_attacks INTEGER
+            )
+            ''')
+            if not cursor.execute('SELECT 1 FROM global_stats').fetchone():
+                cursor.execute('''
+                INSERT INTO global_stats
+                SELECT 1, COUNT(*), COALESCE(SUM(zone_coin), 0), COALESCE(SUM(zone_gem), 0),
+                       COALESCE(SUM(zone_point), 0), COALESCE(SUM(level), 0),
+                       (SELECT COUNT(*) FROM attacks)
+                FROM users
+                ''')
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_stats_user_insert AFTER INSERT ON users
+            BEGIN
+                UPDATE global_stats SET
+                    total_users = total_users + 1,
+                    total_coins = total_coins + NEW.zone_coin,
+                    total_gems = total_gems + NEW.zone_gem,
+                    total_zp = total_zp + NEW.zone_point,
+                    total_levels = total_levels + NEW.level
+                WHERE id = 1;
+            END
+            ''')
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_stats_user_delete AFTER DELETE ON users
+            BEGIN
+                UPDATE global_stats SET
+                    total_users = total_users - 1,
+                    total_coins = total_coins - OLD.zone_coin,
+                    total_gems = total_gems - OLD.zone_gem,
+                    total_zp = total_zp - OLD.zone_point,
+                    total_levels = total_levels - OLD.level
+                WHERE id = 1;
+            END
+            ''')
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_stats_user_update
+            AFTER UPDATE OF zone_coin, zone_gem, zone_point, level ON users
+            BEGIN
+                UPDATE global_stats SET
+                    total_coins = total_coins + NEW.zone_coin - OLD.zone_coin,
+                    total_gems = total_gems + NEW.zone_gem - OLD.zone_gem,
+                    total_zp = total_zp + NEW.zone_point - OLD.zone_point,
+                    total_levels = total_levels + NEW.level - OLD.level
+                WHERE id = 1;
+            END
+            ''')
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_stats_attack_insert AFTER INSERT ON attacks
+            BEGIN
+                UPDATE global_stats SET total_attacks = total_attacks + 1 WHERE id = 1;
+            END
+            ''')
+            
+            # جدول وضعیت‌های FSM
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at INTEGER
+            ) WITHOUT ROWID
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)')
+            
+            self.migrate(cursor)
+            
+            # جدول پیام‌های همگانی (برای ادامه بعد از ری‌استارت)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                text TEXT,
+                status TEXT DEFAULT 'running',
+                total INTEGER DEFAULT 0,
+                last_user_id INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                progress_message_id INTEGER,
+                created_at INTEGER DEFAULT (strftime('%s', 'now')),
+                updated_at INTEGER DEFAULT (strftime('%s', 'now'))
+            )
+            ''')
+    
+    def create_user_missiles(self, cursor):
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS user_missiles (
             user_id INTEGER,
-            missile_name TEXT,
+            missile_id INTEGER,
             quantity INTEGER DEFAULT 0,
-            PRIMARY KEY (user_id, missile_name),
+            PRIMARY KEY (user_id, missile_id),
             FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-        )
+        ) WITHOUT ROWID
         ''')
-        
-        # جدول حمله‌ها
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS attacks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            attacker_id INTEGER,
-            target_id INTEGER,
-            attack_type TEXT,
-            damage INTEGER,
-            loot_coins INTEGER,
-            loot_gems INTEGER,
-            timestamp INTEGER DEFAULT (strftime('%s', 'now')),
-            FOREIGN KEY (attacker_id) REFERENCES users(user_id),
-            FOREIGN KEY (target_id) REFERENCES users(user_id)
-        )
-        ''')
-        
-        conn.commit()
-        conn.close()
+    
+    def migrate(self, cursor):
+        """اجرای مهاجرت‌های اسکیما از نسخه ذخیره‌شده در user_version"""
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            columns = {row['name'] for row in cursor.execute('PRAGMA table_info(user_missiles)')}
+            if 'missile_name' in columns:
+                self.migrate_missile_ids(cursor)
+        if version < 2:
+            # بانس‌های ذخیره‌شده قبلی سقف 50% نداشتند
+            cursor.execute(f'UPDATE users SET total_defense_bonus = {DEFENSE_BONUS_SQL}')
+        if version < 3:
+            # قبلاً برداشت بدون last_miner_claim ممکن نبود؛ تولید کاربران موجود از زمان مهاجرت شروع می‌شود
+            # (نه از created_at، که کل عمر حساب را یکجا پرداخت می‌کرد)
+            cursor.execute('UPDATE users SET last_miner_claim = ? WHERE last_miner_claim IS NULL', (int(time.time()),))
+        if version < self.SCHEMA_VERSION:
+            cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            logger.info(f"Database schema migrated from v{version} to v{self.SCHEMA_VERSION}")
+    
+    def migrate_missile_ids(self, cursor):
+        """نسخه 1: کلید user_missiles از نام فارسی به شناسه عددی موشک"""
+        cursor.execute('ALTER TABLE user_missiles RENAME TO user_missiles_old')
+        self.create_user_missiles(cursor)
+        cursor.executemany('''
+        INSERT INTO user_missiles (user_id, missile_id, quantity)
+        SELECT user_id, ?, quantity FROM user_missiles_old WHERE missile_name = ?
+        ''', [(data['id'], name) for name, data in MISSILE_DATA.items()])
+        cursor.execute(f'''
+        SELECT COUNT(*) FROM user_missiles_old
+        WHERE missile_name NOT IN ({",".join("?" * len(MISSILE_DATA))})
+        ''', list(MISSILE_DATA))
+        unknown = cursor.fetchone()[0]
+        if unknown:
+            logger.warning(f"Dropped {unknown} inventory rows with unknown missile names")
+        cursor.execute('DROP TABLE user_missiles_old')
     
     def register_user(self, user_id: int, username: str, full_name: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, full_name) 
-        VALUES (?, ?, ?)
-        ''', (user_id, username, full_name))
-        
-        # تنظیم ادمین اگر در لیست باشد
-        if user_id in ADMIN_IDS:
-            cursor.execute('UPDATE users SET is_admin = 1 WHERE user_id = ?', (user_id,))
-        
-        # مقدار اولیه موشک‌ها
-        initial_missiles = [
-            (user_id, 'شبح (Ghost)', 5),
-            (user_id, 'رعد (Thunder)', 3),
-            (user_id, 'تندر (Boomer)', 1)
-        ]
-        
-        for missile in initial_missiles:
+        with self.transaction() as cursor:
             cursor.execute('''
-            INSERT OR IGNORE INTO user_missiles (user_id, missile_name, quantity)
+            INSERT OR IGNORE INTO users (user_id, username, full_name) 
             VALUES (?, ?, ?)
-            ''', missile)
-        
-        conn.commit()
-        conn.close()
+            ''', (user_id, username, full_name))
+            
+            # تنظیم ادمین اگر در لیست باشد
+            if user_id in ADMIN_IDS:
+                cursor.execute('UPDATE users SET is_admin = 1 WHERE user_id = ?', (user_id,))
+            self.touch(user_id, missiles=True)
+            
+            # مقدار اولیه موشک‌ها
+            initial_missiles = [
+                (user_id, MISSILE_DATA['شبح (Ghost)']['id'], 5),
+                (user_id, MISSILE_DATA['رعد (Thunder)']['id'], 3),
+                (user_id, MISSILE_DATA['تندر (Boomer)']['id'], 1)
+            ]
+            
+            cursor.executemany('''
+            INSERT OR IGNORE INTO user_missiles (user_id, missile_id, quantity)
+            VALUES (?, ?, ?)
+            ''', initial_missiles)
     
     def get_user(self, user_id: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        return dict(user) if user else None
+        user = self.cache.get(self.cache.users, user_id)
+        if user is None:
+            generation = self.cache.generation
+            cursor = self.get_connection().execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            user = dict(row)
+            self.cache.fill(self.cache.users, user_id, user, generation)
+        return dict(user)
     
     def get_user_missiles(self, user_id: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT missile_name, quantity FROM user_missiles 
+        missiles = self.cache.get(self.cache.missiles, user_id)
+        if missiles is None:
+            generation = self.cache.generation
+            missiles = self.query_missiles(self.get_connection(), user_id)
+            self.cache.fill(self.cache.missiles, user_id, missiles, generation)
+        return [dict(m) for m in missiles]
+    
+    def query_missiles(self, conn, user_id: int):
+        # ترتیب نمایش همان ترتیب کلید اصلی (user_id, missile_id) است
+        cursor = conn.execute('''
+        SELECT missile_id, quantity FROM user_missiles 
         WHERE user_id = ? AND quantity > 0
-        ORDER BY 
-            CASE missile_name
-                WHEN 'شبح (Ghost)' THEN 1
-                WHEN 'رعد (Thunder)' THEN 2
-                WHEN 'تندر (Boomer)' THEN 3
-                WHEN 'هاوک (Hawk)' THEN 4
-                WHEN 'پاتریوت (Patriot)' THEN 5
-                WHEN 'شهاب (Meteor)' THEN 6
-                WHEN 'سیل (Tsunami)' THEN 7
-                WHEN 'توفان (Storm)' THEN 8
-                WHEN 'تایفون (Typhoon)' THEN 9
-                WHEN 'آپوکالیپس (Apocalypse)' THEN 10
-                ELSE 11
-            END
+        ORDER BY missile_id
         ''', (user_id,))
-        missiles = cursor.fetchall()
-        conn.close()
-        return [dict(m) for m in missiles]
+        return [
+            {'missile_name': MISSILE_NAMES[missile_id], 'quantity': quantity}
+            for missile_id, quantity in cursor.fetchall()
+            if missile_id in MISSILE_NAMES
+        ]
     
     def update_user_coins(self, user_id: int, amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE users 
-        SET zone_coin = zone_coin + ? 
-        WHERE user_id = ?
-        ''', (amount, user_id))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+            UPDATE users 
+            SET zone_coin = zone_coin + ? 
+            WHERE user_id = ?
+            ''', (amount, user_id))
+            self.touch(user_id)
     
     def update_user_gems(self, user_id: int, amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE users 
-        SET zone_gem = zone_gem + ? 
-        WHERE user_id = ?
-        ''', (amount, user_id))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+            UPDATE users 
+            SET zone_gem = zone_gem + ? 
+            WHERE user_id = ?
+            ''', (amount, user_id))
+            self.touch(user_id)
     
     def update_user_zp(self, user_id: int, amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE users 
-        SET zone_point = zone_point + ? 
-        WHERE user_id = ?
-        ''', (amount, user_id))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+            UPDATE users 
+            SET zone_point = zone_point + ? 
+            WHERE user_id = ?
+            ''', (amount, user_id))
+            self.touch(user_id)
     
     def add_xp(self, user_id: int, xp_amount: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self.transaction() as cursor:
+            return self.apply_xp(cursor, user_id, xp_amount)
+    
+    def apply_xp(self, cursor, user_id: int, xp_amount: int):
+        """افزودن XP داخل تراکنش جاری (با جایزه هر افزایش لول؛ XP ادغام‌شده ممکن است چند لول بدهد)"""
         cursor.execute('SELECT xp, level FROM users WHERE user_id = ?', (user_id,))
         user = cursor.fetchone()
         
-        if user:
-            current_xp = user['xp'] + xp_amount
-            level = user['level']
-            xp_needed = level * 100
-            
-            if current_xp >= xp_needed:
-                new_level = level + 1
-                remaining_xp = current_xp - xp_needed
-                cursor.execute('''
-                UPDATE users 
-                SET xp = ?, level = ?, zone_coin = zone_coin + 1000, zone_gem = zone_gem + 5
-                WHERE user_id = ?
-                ''', (remaining_xp, new_level, user_id))
-                level_up = True
-            else:
-                cursor.execute('UPDATE users SET xp = ? WHERE user_id = ?', (current_xp, user_id))
-                level_up = False
-            
-            conn.commit()
-            conn.close()
-            return level_up, new_level if level_up else level
-        return False, user['level'] if user else 1
+        if not user:
+            return False, 1
+        self.touch(user_id)
+        
+        current_xp = user['xp'] + xp_amount
+        level = user['level']
+        while current_xp >= level * 100:
+            current_xp -= level * 100
+            level += 1
+        
+        levels = level - user['level']
+        if levels:
+            cursor.execute('''
+            UPDATE users 
+            SET xp = ?, level = ?, zone_coin = zone_coin + ?, zone_gem = zone_gem + ?
+            WHERE user_id = ?
+            ''', (current_xp, level, 1000 * levels, 5 * levels, user_id))
+            return True, level
+        
+        cursor.execute('UPDATE users SET xp = ? WHERE user_id = ?', (current_xp, user_id))
+        return False, level
     
     def get_all_users(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, username, full_name FROM users')
-        users = cursor.fetchall()
-        conn.close()
-        return [dict(u) for u in users]
+        cursor = self.get_connection().execute('SELECT user_id, username, full_name FROM users')
+        return [dict(u) for u in cursor.fetchall()]
     
     def get_top_users(self, limit=10):
+        users = []
+        for user_id in self.leaderboard.top(limit):
+            user = self.get_user(user_id)
+            if user:
+                users.append(user)
+        return users
+    
+    def get_user_rank(self, user_id: int):
+        """(رتبه کاربر، تعداد کل کاربران رنکینگ)"""
+        return self.leaderboard.rank(user_id), len(self.leaderboard)
+    
+    def add_missiles(self, user_id: int, missile_name: str, quantity: int = 1):
+        with self.transaction() as cursor:
+            cursor.execute('''
+            INSERT INTO user_missiles (user_id, missile_id, quantity)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, missile_id)
+            DO UPDATE SET quantity = quantity + excluded.quantity
+            ''', (user_id, MISSILE_DATA[missile_name]['id'], quantity))
+            self.touch(user_id, missiles=True)
+    
+    def claim_miner(self, user_id: int, since: int, now: int):
+        """
+        برداشت ZP ماینر با یک UPDATE شرطی: محاسبه و ثبت زمان برداشت در یک دستور.
+        since زمان شروعی است که caller دیده؛ اگر برداشت دیگری جلو زده باشد None برمی‌گردد.
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''
+            UPDATE users
+            SET zone_point = zone_point + miner_pending(miner_level, COALESCE(last_miner_claim, created_at), :now),
+                last_miner_claim = :now
+            WHERE user_id = :user_id
+              AND COALESCE(last_miner_claim, created_at) = :since
+              AND miner_pending(miner_level, COALESCE(last_miner_claim, created_at), :now) > 0
+            RETURNING zone_point, miner_level
+            ''', {'user_id': user_id, 'since': since, 'now': now})
+            row = cursor.fetchone()
+            if not row:
+                return None
+            self.touch(user_id)
+            return {
+                'zp': miner_pending(row['miner_level'], since, now),
+                'zone_point': row['zone_point'],
+                'miner_level': row['miner_level']
+            }
+    
+    def spend_and_grant(self, user_id: int, coins: int = 0, gems: int = 0,
+                        grant: Optional[dict] = None, expect: Optional[dict] = None):
+        """
+        خرید اتمیک: کسر شرطی هزینه و اعطای آیتم در یک تراکنش.
+        grant: coins / gems / zp / missiles ({نام: تعداد}) / levels ({ستون: افزایش})
+        expect: مقدار فعلی ستون‌های لول که قیمت بر اساس آن حساب شده
+        اگر موجودی کافی نباشد یا لول عوض شده باشد None، وگرنه ردیف تازه کاربر
+        """
+        with self.transaction() as cursor:
+            return self.apply_spend_and_grant(cursor, user_id, coins, gems, grant, expect)
+    
+    def apply_spend_and_grant(self, cursor, user_id: int, coins: int = 0, gems: int = 0,
+                              grant: Optional[dict] = None, expect: Optional[dict] = None):
+        """spend_and_grant داخل تراکنش جاری"""
+        grant = grant or {}
+        levels = grant.get('levels', {})
+        missiles = grant.get('missiles', {})
+        expect = expect or {}
+        if not UPGRADE_COLUMNS.issuperset(levels) or not UPGRADE_COLUMNS.issuperset(expect):
+            raise ValueError("Unknown upgrade column")
+        
+        assignments = [
+            'zone_coin = zone_coin - :coins + :grant_coins',
+            'zone_gem = zone_gem - :gems + :grant_gems',
+            'zone_point = zone_point + :grant_zp'
+        ] + [f'{column} = {column} + :inc_{column}' for column in levels]
+        conditions = ['user_id = :user_id', 'zone_coin >= :coins', 'zone_gem >= :gems'] + [
+            f'{column} = :expect_{column}' for column in expect
+        ]
+        params = {
+            'user_id': user_id,
+            'coins': coins,
+            'gems': gems,
+            'grant_coins': grant.get('coins', 0),
+            'grant_gems': grant.get('gems', 0),
+            'grant_zp': grant.get('zp', 0)
+        }
+        params.update({f'inc_{column}': amount for column, amount in levels.items()})
+        params.update({f'expect_{column}': value for column, value in expect.items()})
+        
+        cursor.execute(
+            f'UPDATE users SET {", ".join(assignments)} WHERE {" AND ".join(conditions)} RETURNING *',
+            params
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        self.touch(user_id, missiles=bool(missiles))
+        
+        if any(column in DEFENSE_COLUMNS.values() for column in levels):
+            row = self.update_defense_bonus(cursor, user_id)
+        
+        cursor.executemany('''
+        INSERT INTO user_missiles (user_id, missile_id, quantity)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, missile_id)
+        DO UPDATE SET quantity = quantity + excluded.quantity
+        ''', [
+            (user_id, MISSILE_DATA[missile_name]['id'], quantity)
+            for missile_name, quantity in missiles.items()
+            if quantity
+        ])
+        return dict(row)
+    
+    def buy_missiles(self, user_id: int, missile_name: str, quantity: Optional[int] = None):
+        """
+        خرید quantity موشک در یک تراکنش؛ quantity=None یعنی حداکثر تعداد قابل پرداخت
+        که از موجودی لحظه‌ای (زیر قفل نویسنده) محاسبه می‌شود. (تعداد، ردیف تازه) یا None
+        """
+        missile = MISSILE_DATA[missile_name]
+        price, gem_cost = missile['price'], missile.get('gem_cost', 0)
+        with self.transaction() as cursor:
+            if quantity is None:
+                cursor.execute('SELECT zone_coin, zone_gem FROM users WHERE user_id = ?', (user_id,))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                quantity = row['zone_coin'] // price
+                if gem_cost:
+                    quantity = min(quantity, row['zone_gem'] // gem_cost)
+                if quantity <= 0:
+                    return None
+            user = self.apply_spend_and_grant(
+                cursor, user_id, coins=price * quantity, gems=gem_cost * quantity,
+                grant={'missiles': {missile_name: quantity}}
+            )
+            return (quantity, user) if user else None
+    
+    def update_defense_bonus(self, cursor, user_id: int):
+        """محاسبه مجدد بانس کل دفاع (با سقف 50%) داخل تراکنش جاری"""
+        cursor.execute(f'UPDATE users SET total_defense_bonus = {DEFENSE_BONUS_SQL} WHERE user_id = ? RETURNING *', (user_id,))
+        return cursor.fetchone()
+    
+    def set_user_level(self, user_id: int, level: int):
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE users SET level = ? WHERE user_id = ?', (level, user_id))
+            self.touch(user_id)
+    
+    def insert_attacks(self, rows: List[tuple]):
+        """ذخیره دسته‌ای رویدادهای حمله"""
+        with self.transaction() as cursor:
+            cursor.executemany(f'''
+            INSERT INTO attacks ({', '.join(ATTACK_LOG_FIELDS)})
+            VALUES ({', '.join('?' * len(ATTACK_LOG_FIELDS))})
+            ''', rows)
+    
+    def get_attack_history(self, user_id: int, limit: int = 10):
+        """آخرین حمله‌های کاربر با استفاده از ایندکس‌های attacker و target"""
+        fields = ', '.join(ATTACK_LOG_FIELDS)
+        cursor = self.get_connection().execute(f'''
+        SELECT * FROM (
+            SELECT {fields} FROM attacks WHERE attacker_id = ? ORDER BY timestamp DESC LIMIT ?
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT {fields} FROM attacks WHERE target_id = ? ORDER BY timestamp DESC LIMIT ?
+        )
+        ORDER BY timestamp DESC LIMIT ?
+        ''', (user_id, limit, user_id, limit, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def get_user_ids_after(self, last_user_id: int, limit: int):
+        """صفحه‌بندی keyset آیدی کاربران"""
+        cursor = self.get_connection().execute(
+            'SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+            (last_user_id, limit)
+        )
+        return [row[0] for row in cursor.fetchall()]
+    
+    def create_broadcast(self, admin_id: int, text: str):
+        with self.transaction() as cursor:
+            cursor.execute('''
+            INSERT INTO broadcast_jobs (admin_id, text, total)
+            VALUES (?, ?, (SELECT COUNT(*) FROM users))
+            ''', (admin_id, text))
+            job_id = cursor.lastrowid
+            cursor.execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,))
+            return dict(cursor.fetchone())
+    
+    def save_broadcast(self, job: dict):
+        """ذخیره پیشرفت یک پیام همگانی"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+            UPDATE broadcast_jobs
+            SET status = ?, last_user_id = ?, sent = ?, failed = ?, blocked = ?,
+                progress_message_id = ?, updated_at = strftime('%s', 'now')
+            WHERE id = ?
+            ''', (job['status'], job['last_user_id'], job['sent'], job['failed'], job['blocked'],
+                  job['progress_message_id'], job['id']))
+    
+    def get_running_broadcasts(self):
+        cursor = self.get_connection().execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def fsm_load(self, key: str):
+        cursor = self.get_connection().execute(
+            'SELECT state, data, updated_at FROM fsm_states WHERE key = ?', (key,)
+        )
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def fsm_save(self, upserts: List[tuple], deletes: List[tuple]):
+        """ذخیره دسته‌ای وضعیت‌های FSM"""
+        with self.transaction() as cursor:
+            cursor.executemany('''
+            INSERT INTO fsm_states (key, state, data, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            ''', upserts)
+            cursor.executemany('DELETE FROM fsm_states WHERE key = ?', deletes)
+    
+    def fsm_expire(self, before: int):
+        """حذف وضعیت‌های FSM قدیمی‌تر از before"""
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM fsm_states WHERE updated_at < ?', (before,))
+            return cursor.rowcount
+    
+    def apply_deltas(self, deltas: Dict[int, dict]):
+        """اعمال تغییرات ادغام‌شده سکه/جم/ZP/XP چند کاربر در یک تراکنش؛ خروجی نتیجه XP هر کاربر"""
+        results = {}
+        with self.transaction() as cursor:
+            cursor.executemany('''
+            UPDATE users 
+            SET zone_coin = zone_coin + ?, zone_gem = zone_gem + ?, zone_point = zone_point + ?
+            WHERE user_id = ?
+            ''', [
+                (delta['coins'], delta['gems'], delta['zp'], user_id)
+                for user_id, delta in deltas.items()
+                if delta['coins'] or delta['gems'] or delta['zp']
+            ])
+            
+            for user_id, delta in deltas.items():
+                self.touch(user_id)
+                if delta['xp']:
+                    results[user_id] = self.apply_xp(cursor, user_id, delta['xp'])
+        return results
+    
+    def resolve_attack(self, attacker_id: int, target_id: int, attack_type: str):
+        """
+        انجام کامل حمله در یک تراکنش: بررسی نیازمندی‌ها، خسارت و غنیمت،
+        انتقال منابع و کسر موشک. XP با GroupCommitWriter و ثبت در جدول attacks با AttackLog انجام می‌شود.
+        در صورت خطا {'error': ...} و در غیر این صورت گزارش حمله با موجودی‌های جدید برمی‌گردد.
+        """
+        if attacker_id == target_id:
+            return {'error': 'self'}
+        
+        combo = ATTACK_COMBOS.get(ATTACK_TYPES.get(attack_type))
+        if not combo:
+            return {'error': 'invalid_type'}
+        
+        with self.transaction() as cursor:
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (attacker_id,))
+            attacker = cursor.fetchone()
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (target_id,))
+            target = cursor.fetchone()
+            
+            if not attacker or not target:
+                return {'error': 'not_found'}
+            
+            # بررسی سطح
+            if attacker['level'] < combo['min_level']:
+                return {'error': 'min_level', 'required': combo['min_level']}
+            
+            # بررسی نیازمندی‌ها
+            missiles_needed = {}
+            for req, amount in combo['requirements'].items():
+                if req in MISSILE_DATA:
+                    cursor.execute('''
+                    SELECT quantity FROM user_missiles WHERE user_id = ? AND missile_id = ?
+                    ''', (attacker_id, MISSILE_DATA[req]['id']))
+                    row = cursor.fetchone()
+                    if not row or row['quantity'] < amount:
+                        return {'error': 'missile', 'missile': req, 'required': amount}
+                    missiles_needed[req] = amount
+                elif req == 'zone_gem':
+                    if attacker['zone_gem'] < amount:
+                        return {'error': 'gem', 'required': amount}
+            
+            # محاسبه خسارت با در نظر گرفتن دفاع
+            base_damage = 100 + (attacker['level'] * 10)
+            damage = int(base_damage * combo['multiplier'] * (1 - target['total_defense_bonus']))
+            
+            # محاسبه غنیمت (حداکثر 15% از دارایی هدف)
+            loot_coins = min(int(target['zone_coin'] * 0.15), 5000)
+            loot_gems = min(int(target['zone_gem'] * 0.10), 50)
+            
+            # انتقال منابع
+            cursor.execute('''
+            UPDATE users 
+            SET zone_coin = MAX(zone_coin - ?, 0), zone_gem = MAX(zone_gem - ?, 0)
+            WHERE user_id = ?
+            ''', (loot_coins, loot_gems, target_id))
+            cursor.execute('''
+            UPDATE users 
+            SET zone_coin = zone_coin + ?, zone_gem = zone_gem + ?
+            WHERE user_id = ?
+            ''', (loot_coins, loot_gems, attacker_id))
+            
+            # کسر موشک‌ها
+            cursor.executemany('''
+            UPDATE user_missiles
+            SET quantity = quantity - ?
+            WHERE user_id = ? AND missile_id = ?
+            ''', [(amount, attacker_id, MISSILE_DATA[name]['id']) for name, amount in missiles_needed.items()])
+            self.touch(attacker_id, missiles=True)
+            self.touch(target_id)
+            
+            # موجودی‌های نهایی
+            cursor.execute('SELECT user_id, zone_coin, zone_gem FROM users WHERE user_id IN (?, ?)',
+                           (attacker_id, target_id))
+            balances = {row['user_id']: row for row in cursor.fetchall()}
+        
+        return {
+            'attacker_name': attacker['full_name'],
+            'target_name': target['full_name'],
+            'attack_name': ATTACK_TYPES[attack_type],
+            'defense_bonus': target['total_defense_bonus'],
+            'damage': damage,
+            'loot_coins': loot_coins,
+            'loot_gems': loot_gems,
+            'xp': ATTACK_XP,
+            'attacker_coins': balances[attacker_id]['zone_coin'],
+            'attacker_gems': balances[attacker_id]['zone_gem'],
+            'target_coins': balances[target_id]['zone_coin'],
+            'target_gems': balances[target_id]['zone_gem']
+        }
+    
+    def gift_all(self, coins: int = 0, gems: int = 0, zp: int = 0,
+                 missiles: Optional[Dict[str, int]] = None,
+                 min_level: Optional[int] = None, active_days: Optional[int] = None):
+        """
+        هدیه همگانی با دو دستور set-based در یک تراکنش.
+        active_days: فقط کاربرانی که در این چند روز حمله کرده‌اند.
+        خروجی: تعداد کاربران دریافت‌کننده
+        """
+        conditions, params = ['1'], []
+        if min_level:
+            conditions.append('level >= ?')
+            params.append(min_level)
+        if active_days:
+            conditions.append('''EXISTS (
+                SELECT 1 FROM attacks
+                WHERE attacks.attacker_id = users.user_id AND attacks.timestamp >= ?
+            )''')
+            params.append(int(time.time()) - active_days * 86400)
+        where = ' AND '.join(conditions)
+        
+        count = 0
+        with self.transaction() as cursor:
+            if coins or gems or zp:
+                cursor.execute(f'''
+                UPDATE users 
+                SET zone_coin = zone_coin + ?, zone_gem = zone_gem + ?, zone_point = zone_point + ?
+                WHERE {where}
+                ''', [coins, gems, zp] + params)
+                count = cursor.rowcount
+            
+            for missile_name, quantity in (missiles or {}).items():
+                cursor.execute(f'''
+                INSERT INTO user_missiles (user_id, missile_id, quantity)
+                SELECT user_id, ?, ? FROM users WHERE {where}
+                ON CONFLICT(user_id, missile_id)
+                DO UPDATE SET quantity = quantity + excluded.quantity
+                ''', [MISSILE_DATA[missile_name]['id'], quantity] + params)
+                count = max(count, cursor.rowcount)
+            
+            self.touch_all()
+        return count
+    
+    def get_admin_stats(self):
+        """آمار کامل ربات برای پنل ادمین (شمارنده‌های global_stats + ایندکس created_at)"""
         conn = self.get_connection()
         cursor = conn.cursor()
+
+        # آمار کلی
+        cursor.execute('SELECT * FROM global_stats WHERE id = 1')
+        stats = dict(cursor.fetchone())
+        stats['avg_level'] = stats['total_levels'] / stats['total_users'] if stats['total_users'] else 0
+
+        # آخرین کاربران
         cursor.execute('''
-        SELECT user_id, username, full_name, zone_coin, zone_gem, zone_point, level
-        FROM users 
-        ORDER BY zone_coin DESC 
-        LIMIT ?
-        ''', (limit,))
-        users = cursor.fetchall()
-        conn.close()
-        return [dict(u) for u in users]
+        SELECT user_id, username, full_name, created_at
+        FROM users
+        ORDER BY created_at DESC
+        LIMIT 5
+        ''')
+        stats['recent_users'] = [dict(u) for u in cursor.fetchall()]
+
+        # فعالیت امروز
+        today = int(time.time()) - 86400
+        cursor.execute('SELECT COUNT(*) as today_users FROM users WHERE created_at > ?', (today,))
+        stats['today_users'] = cursor.fetchone()['today_users']
+
+        return stats
+    
+    def ping(self):
+        """بررسی دسترسی به دیتابیس (برای /ready)"""
+        self.get_connection().execute('SELECT 1').fetchone()
+        return True
+
+# === لایه async دیتابیس ===
+class AsyncDatabase:
+    """نسخه awaitable همه متدهای Database که روی executor اختصاصی اجرا می‌شوند"""
+
+    def __init__(self, database: Database, workers: int = 4, queue_size: int = 256):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+        # صف محدود: بیش از queue_size درخواست همزمان منتظر جای خالی می‌مانند
+        self.slots = asyncio.Semaphore(queue_size)
+
+    async def run(self, func, *args, **kwargs):
+        """اجرای یک تابع همگام دیتابیس خارج از event loop"""
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.timed, time.perf_counter(), func, args, kwargs)
+
+    @staticmethod
+    def timed(submitted: float, func, args, kwargs):
+        """اجرا داخل thread دیتابیس همراه با زمان انتظار صف و زمان اجرا"""
+        name = func.__name__
+        start = time.perf_counter()
+        metrics.observe('warzone_db_wait_seconds', start - submitted, method=name)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            metrics.inc('warzone_db_errors_total', method=name)
+            raise
+        finally:
+            metrics.observe('warzone_db_query_seconds', time.perf_counter() - start, method=name)
+
+    def __getattr__(self, name):
+        method = getattr(self.database, name)
+        if not callable(method):
+            return method
+
+        async def async_method(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+
+        async_method.__name__ = name
+        setattr(self, name, async_method)
+        return async_method
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.database.close()
+
+# === نوشتن گروهی (group commit) ===
+class GroupCommitWriter:
+    """
+    صف تغییرات کوچک و بدون شرط سکه/جم/ZP/XP (XP حمله‌ها، هدیه‌های ادمین): تغییرات هر کاربر ادغام می‌شوند و هر
+    max_delay ثانیه یا هر max_batch عملیات (هر کدام زودتر) با یک commit ذخیره می‌شوند.
+    """
 
-# === راه‌اندازی دیتابیس ===
-db = Database()
+    def __init__(self, adb: AsyncDatabase, max_delay: float = 0.005, max_batch: int = 500):
+        self.adb = adb
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.full = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        # آمار
+        self.batches = 0
+        self.operations = 0
+        self.max_batch_seen = 0
+        self.flush_time = 0.0
+        self.last_flush_ms = 0.0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.stopping = False
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """ذخیره باقی‌مانده صف و توقف"""
+        if self.task and not self.task.done():
+            self.queue.put_nowait(None)
+            self.full.set()
+            await self.task
+        self.task = None
+
+    async def add(self, user_id: int, coins: int = 0, gems: int = 0, zp: int = 0, xp: int = 0):
+        """ثبت تغییر؛ بعد از commit شدن برمی‌گردد (برای XP نتیجه (level_up, new_level))"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((user_id, coins, gems, zp, xp, future))
+        if self.queue.qsize() >= self.max_batch:
+            self.full.set()
+        return await future
+
+    def drain(self, batch):
+        while len(batch) < self.max_batch and not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is None:
+                self.stopping = True
+                break
+            batch.append(item)
+        return batch
+
+    async def run(self):
+        while not self.stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            if self.queue.qsize() < self.max_batch - 1:
+                self.full.clear()
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush(self.drain(batch))
+
+    async def flush(self, batch):
+        # ادغام تغییرات هر کاربر
+        deltas = {}
+        for user_id, coins, gems, zp, xp, _ in batch:
+            delta = deltas.get(user_id)
+            if delta is None:
+                delta = deltas[user_id] = {'coins': 0, 'gems': 0, 'zp': 0, 'xp': 0}
+            delta['coins'] += coins
+            delta['gems'] += gems
+            delta['zp'] += zp
+            delta['xp'] += xp
+
+        start = time.perf_counter()
+        try:
+            results = await self.adb.apply_deltas(deltas)
+        except Exception as e:
+            logger.error(f"Group commit failed ({len(batch)} ops): {e}")
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        elapsed = time.perf_counter() - start
+        self.batches += 1
+        self.operations += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        self.flush_time += elapsed
+        self.last_flush_ms = elapsed * 1000
+        metrics.observe('warzone_write_batch_size', len(batch))
+        metrics.observe('warzone_write_flush_seconds', elapsed)
+
+        for user_id, *_, future in batch:
+            result = results.get(user_id)
+            if result and result[0]:
+                # افزایش لول ادغام‌شده فقط یک بار گزارش می‌شود
+                results[user_id] = (False, result[1])
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        """آمار اندازه دسته‌ها و تأخیر flush"""
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'avg_batch_size': self.operations / self.batches if self.batches else 0,
+            'max_batch_size': self.max_batch_seen,
+            'avg_flush_ms': self.flush_time * 1000 / self.batches if self.batches else 0,
+            'last_flush_ms': self.last_flush_ms
+        }
+
+# === لاگ حمله‌ها ===
+ATTACK_LOG_FIELDS = ('attacker_id', 'target_id', 'attack_type', 'damage', 'loot_coins', 'loot_gems', 'timestamp')
+
+class AttackLog:
+    """
+    بافر حلقوی رویدادهای حمله؛ هر interval ثانیه یا با رسیدن به batch_size رویداد
+    با executemany در جدول attacks نوشته می‌شود. اگر بافر پر شود قدیمی‌ترین رویدادها کنار می‌روند.
+    """
+
+    def __init__(self, adb: AsyncDatabase, capacity: int = 10000, batch_size: int = 200,
+                 interval: float = 1.0):
+        self.adb = adb
+        self.buffer = deque(maxlen=capacity)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.flushing = []  # دسته در حال نوشتن (برای history)
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.stopping = False
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        توقف بدون cancel: insert در thread دیتابیس با cancel متوقف نمی‌شود و دسته در حال نوشتن
+        گم می‌شد؛ حلقه flush جاری را تمام می‌کند و باقی‌مانده بافر بعد از آن نوشته می‌شود
+        """
+        if self.task:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        await self.flush()
+
+    def record(self, attacker_id: int, target_id: int, attack_type: str,
+               damage: int, loot_coins: int, loot_gems: int):
+        """ثبت حمله در بافر (بدون دسترسی به دیتابیس)"""
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((attacker_id, target_id, attack_type, damage, loot_coins, loot_gems, int(time.time())))
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+        self.start()
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.stopping:
+                break
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Attack log flush error: {e}")
+
+    async def flush(self):
+        while self.buffer:
+            batch = self.flushing = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            try:
+                await self.adb.insert_attacks(batch)
+            except Exception:
+                self.buffer.extendleft(reversed(batch))
+                raise
+            finally:
+                self.flushing = []
+            self.written += len(batch)
+
+    async def history(self, user_id: int, limit: int = 10):
+        """آخرین حمله‌های کاربر (به عنوان حمله‌کننده یا هدف)، شامل رویدادهای هنوز ذخیره‌نشده"""
+        pending = [
+            dict(zip(ATTACK_LOG_FIELDS, row)) for row in (*self.flushing, *self.buffer)
+            if row[0] == user_id or row[1] == user_id
+        ]
+        rows = await self.adb.get_attack_history(user_id, limit)
+        # رویدادی که همزمان با این خواندن ذخیره شده هم در بافر دیده شده و هم در جدول است
+        unseen = Counter(tuple(row.values()) for row in pending)
+        for row in rows:
+            key = tuple(row.values())
+            if unseen[key]:
+                unseen[key] -= 1
+            else:
+                pending.append(row)
+        rows = pending
+        rows.sort(key=lambda row: row['timestamp'], reverse=True)
+        return rows[:limit]
+
+    def stats(self):
+        return {
+            'pending': len(self.buffer),
+            'written': self.written,
+            'dropped': self.dropped
+        }
+
+# === ذخیره‌ساز FSM ===
+class SQLiteStorage(BaseStorage):
+    """
+    ذخیره‌ساز FSM روی همان فایل sqlite: لایه داغ LRU در حافظه، انقضای وضعیت‌های
+    قدیمی بعد از ttl ثانیه و ذخیره دسته‌ای تغییرات هر flush_interval ثانیه.
+    """
+
+    EMPTY = (None, {}, 0)
+    EXPIRE_INTERVAL = 600
+
+    def __init__(self, adb: AsyncDatabase, max_hot: int = 10000, ttl: int = 86400,
+                 flush_interval: float = 1.0):
+        self.adb = adb
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self.max_hot = max_hot
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # کلید -> (state, data, updated_at)
+        self.hot = OrderedDict()
+        self.dirty = {}
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        last_expire = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_expire >= self.EXPIRE_INTERVAL:
+                    last_expire = time.monotonic()
+                    expired = await self.adb.fsm_expire(int(time.time()) - self.ttl)
+                    if expired:
+                        logger.info(f"FSM storage expired {expired} stale states")
+            except Exception as e:
+                logger.error(f"FSM storage flush error: {e}")
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        upserts, deletes = [], []
+        for key, (state, data, updated_at) in batch.items():
+            if state is None and not data:
+                deletes.append((key,))
+            else:
+                upserts.append((key, state, json.dumps(data, ensure_ascii=False), updated_at))
+        try:
+            await self.adb.fsm_save(upserts, deletes)
+        except Exception:
+            # بازگرداندن به صف برای تلاش بعدی (تغییرات جدیدتر حفظ می‌شوند)
+            for key, record in batch.items():
+                self.dirty.setdefault(key, record)
+            raise
+
+    def remember(self, key: str, record: tuple):
+        self.hot[key] = record
+        self.hot.move_to_end(key)
+        while len(self.hot) > self.max_hot:
+            self.hot.popitem(last=False)
+
+    async def load(self, key: StorageKey):
+        k = self.key_builder.build(key)
+        record = self.hot.get(k) or self.dirty.get(k)
+        if record is None:
+            row = await self.adb.fsm_load(k)
+            # ممکن است در حین خواندن مقدار جدیدتری نوشته شده باشد
+            record = self.hot.get(k) or self.dirty.get(k)
+            if record is None:
+                record = (row['state'], json.loads(row['data']), row['updated_at']) if row else self.EMPTY
+        if record[2] and record[2] < time.time() - self.ttl:
+            record = self.EMPTY
+        self.remember(k, record)
+        return k, record
+
+    def write(self, key: str, record: tuple):
+        self.remember(key, record)
+        self.dirty[key] = record
+        self.start()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, record = await self.load(key)
+        state = state.state if isinstance(state, State) else state
+        self.write(k, (state, record[1], int(time.time())))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, record = await self.load(key)
+        return record[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k, record = await self.load(key)
+        self.write(k, (record[0], data.copy(), int(time.time())))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, record = await self.load(key)
+        return record[1].copy()
+
+    async def close(self) -> None:
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+# === قفل کاربران ===
+class UserLocks:
+    """
+    قفل async جدا برای هر کاربر در چند shard؛ قفل وقتی کسی نگهش ندارد یا منتظرش
+    نباشد حذف می‌شود، پس حافظه فقط به اندازه کاربران فعال است.
+    """
+
+    def __init__(self, shards: int = 64):
+        self.shards = [{} for _ in range(shards)]
+        self.contended = 0
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @asynccontextmanager
+    async def hold(self, *user_ids: int):
+        """قفل چند کاربر به ترتیب صعودی آیدی تا دو درخواست متقابل deadlock نشوند"""
+        acquired = []
+        try:
+            for user_id in sorted(set(user_ids)):
+                await self.acquire(user_id)
+                acquired.append(user_id)
+            yield
+        finally:
+            for user_id in reversed(acquired):
+                self.release(user_id)
+
+    async def acquire(self, user_id: int):
+        shard = self.shards[user_id % len(self.shards)]
+        entry = shard.get(user_id)
+        if entry is None:
+            entry = shard[user_id] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.contended += 1
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self.unref(shard, user_id, entry)
+            raise
+
+    def release(self, user_id: int):
+        shard = self.shards[user_id % len(self.shards)]
+        entry = shard[user_id]
+        entry[0].release()
+        self.unref(shard, user_id, entry)
+
+    @staticmethod
+    def unref(shard: dict, user_id: int, entry: list):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del shard[user_id]
+
+async def user_lock_middleware(handler, event, data):
+    """هندلرهای پیام یک کاربر پشت سر هم اجرا می‌شوند (callbackها در CallbackRouter قفل می‌شوند)"""
+    user = data.get('event_from_user')
+    if user is None:
+        return await handler(event, data)
+    async with user_locks.hold(user.id):
+        return await handler(event, data)
+
+# === محدودیت نرخ کاربران (anti-flood) ===
+# نام هندلر -> کلاس عملیات (بقیه هندلرها 'read' هستند)
+THROTTLE_CLASSES = {
+    'cmd_start': 'mutation',
+    'process_buy': 'mutation',
+    'process_buy_quantity': 'mutation',
+    'process_box': 'mutation',
+    'process_box_bulk': 'mutation',
+    'process_claim_miner': 'mutation',
+    'process_upgrade_miner': 'mutation',
+    'process_upgrade_defense': 'mutation',
+    'process_upgrade_miner_max': 'mutation',
+    'process_upgrade_defense_max': 'mutation',
+    'cmd_attack_reply': 'attack',
+    'process_quick_attack': 'attack'
+}
+
+class Throttle:
+    """
+    token bucket فشرده برای هر (کلاس عملیات، کاربر): [توکن‌ها، زمان آخرین به‌روزرسانی، هشدار داده شده].
+    bucketی که دوباره پر شده با bucket تازه فرقی ندارد و در sweep دوره‌ای حذف می‌شود.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], classes: Dict[str, str], sweep_interval: float = 60):
+        self.limits = limits
+        self.classes = classes
+        self.buckets = {name: {} for name in limits}
+        self.sweep_interval = sweep_interval
+        self.next_sweep = time.monotonic() + sweep_interval
+
+    def action_class(self, handler_name: str):
+        return self.classes.get(handler_name, 'read')
+
+    def allow(self, user_id: int, action_class: str):
+        now = time.monotonic()
+        if now >= self.next_sweep:
+            self.sweep(now)
+        rate, burst = self.limits[action_class]
+        buckets = self.buckets[action_class]
+        entry = buckets.get(user_id)
+        if entry is None:
+            buckets[user_id] = [burst - 1, now, False]
+            return True
+        tokens = min(burst, entry[0] + (now - entry[1]) * rate)
+        entry[1] = now
+        if tokens >= 1:
+            entry[0] = tokens - 1
+            entry[2] = False
+            return True
+        entry[0] = tokens
+        metrics.inc('warzone_throttled_total', action=action_class)
+        return False
+
+    def warn_once(self, user_id: int, action_class: str):
+        """True فقط برای اولین رد در هر دوره محدودیت (پیام‌های بعدی بی‌پاسخ می‌مانند)"""
+        entry = self.buckets[action_class][user_id]
+        if entry[2]:
+            return False
+        entry[2] = True
+        return True
+
+    def sweep(self, now: float):
+        """حذف bucketهای بیکار (پر شده)"""
+        self.next_sweep = now + self.sweep_interval
+        for action_class, buckets in self.buckets.items():
+            rate, burst = self.limits[action_class]
+            idle = [user_id for user_id, (tokens, updated, _) in buckets.items() if tokens + (now - updated) * rate >= burst]
+            for user_id in idle:
+                del buckets[user_id]
+
+    def __len__(self):
+        return sum(len(buckets) for buckets in self.buckets.values())
+
+THROTTLE_MESSAGE = "⏳ لطفاً کمی آهسته‌تر! چند لحظه دیگر دوباره امتحان کنید."
+
+async def throttle_middleware(handler, event, data):
+    """رد پیام‌های بیش از حد قبل از هر کار دیتابیس (callbackها در CallbackRouter بررسی می‌شوند)"""
+    user = data.get('event_from_user')
+    if user is None or is_admin(user.id):
+        return await handler(event, data)
+    action_class = throttle.action_class(data['handler'].callback.__name__)
+    if throttle.allow(user.id, action_class):
+        return await handler(event, data)
+    if throttle.warn_once(user.id, action_class):
+        await event.answer(THROTTLE_MESSAGE)
+
+# === جدول جوایز (loot) ===
+class AliasSampler:
+    """نمونه‌برداری O(1) از یک توزیع گسسته وزن‌دار (روش alias، نسخه Vose)"""
+
+    def __init__(self, weights: List[float]):
+        size, total = len(weights), sum(weights)
+        scaled = [weight * size / total for weight in weights]
+        self.prob = [1.0] * size
+        self.alias = list(range(size))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+
+    def counts(self, n: int):
+        """تعداد دفعات انتخاب هر نتیجه در n نمونه"""
+        prob, alias, size, rand = self.prob, self.alias, len(self.prob), random.random
+        hits = [0] * size
+        for _ in range(n):
+            i = int(rand() * size)
+            hits[i if rand() < prob[i] else alias[i]] += 1
+        return hits
+
+class LootTable:
+    """
+    جوایز یک باکس به صورت داده: لیست نتایج وزن‌دار با coins/zp (بازه [min, max])،
+    missile (یک عدد) و jackpot اختیاری. n باکس یکجا رول و در یک تغییر تجمیع می‌شوند.
+    """
+
+    def __init__(self, outcomes: List[dict]):
+        self.outcomes = outcomes
+        self.sampler = AliasSampler([outcome['weight'] for outcome in outcomes])
+
+    def roll(self, count: int = 1):
+        loot = {'coins': 0, 'zp': 0, 'missiles': {}, 'jackpots': 0}
+        for outcome, hits in zip(self.outcomes, self.sampler.counts(count)):
+            if not hits:
+                continue
+            for key in ('coins', 'zp'):
+                if key in outcome:
+                    low, high = outcome[key]
+                    loot[key] += sum(random.randint(low, high) for _ in range(hits))
+            if 'missile' in outcome:
+                loot['missiles'][outcome['missile']] = hits
+            if outcome.get('jackpot'):
+                loot['jackpots'] += hits
+        return loot
+
+    def describe(self):
+        """متن جوایز ممکن برای منو (شانس جکپات از وزن‌ها)"""
+        total = sum(outcome['weight'] for outcome in self.outcomes)
+        parts = []
+        for outcome in self.outcomes:
+            prizes = [f"{outcome[key][0]:,}-{outcome[key][1]:,} {unit}"
+                      for key, unit in (('coins', 'سکه'), ('zp', 'ZP')) if key in outcome]
+            if 'missile' in outcome:
+                prizes.append(outcome['missile'])
+            text = " + ".join(prizes)
+            if outcome.get('jackpot'):
+                text = f"جکپات {outcome['weight'] * 100 / total:g}%: {text}"
+            parts.append(text)
+        return " / ".join(parts)
+
+def loot_text(loot: dict):
+    parts = []
+    if loot['coins']:
+        parts.append(f"{loot['coins']:,} سکه")
+    if loot['zp']:
+        parts.append(f"{loot['zp']:,} ZP")
+    for name, quantity in loot['missiles'].items():
+        parts.append(f"{quantity} عدد {name}")
+    text = " + ".join(parts)
+    if loot['jackpots'] == 1:
+        return f"🎉 جکپات! {text}"
+    if loot['jackpots']:
+        return f"🎉 {loot['jackpots']} جکپات! {text}"
+    return text
+
+def loot_value(loot: dict):
+    """ارزش تقریبی جوایز به سکه"""
+    return loot['coins'] + loot['zp'] + sum(
+        MISSILE_DATA[name]['price'] * quantity for name, quantity in loot['missiles'].items()
+    )
 
 # === داده‌های بازی ===
+# id: شناسه ثابت در جدول user_missiles و همان ترتیب نمایش (موشک جدید فقط با id بزرگ‌تر)
 MISSILE_DATA = {
     # موشک‌های معمولی
-    'شبح (Ghost)': {'damage': 50, 'price': 200, 'min_level': 1, 'type': 'normal'},
-    'رعد (Thunder)': {'damage': 70, 'price': 500, 'min_level': 2, 'type': 'normal'},
-    'تندر (Boomer)': {'damage': 90, 'price': 1000, 'min_level': 3, 'type': 'normal'},
-    'هاوک (Hawk)': {'damage': 110, 'price': 2000, 'min_level': 4, 'type': 'normal'},
-    'پاتریوت (Patriot)': {'damage': 130, 'price': 5000, 'min_level': 5, 'type': 'normal'},
+    'شبح (Ghost)': {'id': 1, 'damage': 50, 'price': 200, 'min_level': 1, 'type': 'normal'},
+    'رعد (Thunder)': {'id': 2, 'damage': 70, 'price': 500, 'min_level': 2, 'type': 'normal'},
+    'تندر (Boomer)': {'id': 3, 'damage': 90, 'price': 1000, 'min_level': 3, 'type': 'normal'},
+    'هاوک (Hawk)': {'id': 4, 'damage': 110, 'price': 2000, 'min_level': 4, 'type': 'normal'},
+    'پاتریوت (Patriot)': {'id': 5, 'damage': 130, 'price': 5000, 'min_level': 5, 'type': 'normal'},
     
     # موشک‌های ویژه
-    'شهاب (Meteor)': {'damage': 250, 'price': 25000, 'min_level': 6, 'type': 'special', 'gem_cost': 1},
-    'سیل (Tsunami)': {'damage': 300, 'price': 30000, 'min_level': 7, 'type': 'special', 'gem_cost': 2},
-    'توفان (Storm)': {'damage': 350, 'price': 35000, 'min_level': 8, 'type': 'special', 'gem_cost': 3},
-    'تایفون (Typhoon)': {'damage': 400, 'price': 40000, 'min_level': 9, 'type': 'special', 'gem_cost': 4},
-    'آپوکالیپس (Apocalypse)': {'damage': 500, 'price': 50000, 'min_level': 10, 'type': 'special', 'gem_cost': 5}
+    'شهاب (Meteor)': {'id': 6, 'damage': 250, 'price': 25000, 'min_level': 6, 'type': 'special', 'gem_cost': 1},
+    'سیل (Tsunami)': {'id': 7, 'damage': 300, 'price': 30000, 'min_level': 7, 'type': 'special', 'gem_cost': 2},
+    'توفان (Storm)': {'id': 8, 'damage': 350, 'price': 35000, 'min_level': 8, 'type': 'special', 'gem_cost': 3},
+    'تایفون (Typhoon)': {'id': 9, 'damage': 400, 'price': 40000, 'min_level': 9, 'type': 'special', 'gem_cost': 4},
+    'آپوکالیپس (Apocalypse)': {'id': 10, 'damage': 500, 'price': 50000, 'min_level': 10, 'type': 'special', 'gem_cost': 5}
 }
 
+MISSILE_NAMES = {data['id']: name for name, data in MISSILE_DATA.items()}
+# تعدادهای خرید در بازار ('max' = حداکثر مقدار قابل پرداخت)
+BUY_QUANTITIES = (1, 5, 10, 'max')
+
 ATTACK_COMBOS = {
     'حمله ساده': {
         'multiplier': 1.0,
@@ -319,6 +1910,53 @@ ATTACK_COMBOS = {
     }
 }
 
+# نوع حمله در callback_data -> نام combo
+ATTACK_TYPES = {
+    'simple': 'حمله ساده',
+    'medium': 'حمله متوسط',
+    'advanced': 'حمله پیشرفته',
+    'nuclear': 'حمله ویرانگر'
+}
+
+ATTACK_XP = 50
+
+# باکس‌ها (کد callback -> نام، آیکون، بازه جایزه و هزینه)
+BOX_DATA = {
+    'coin': {'name': 'باکس سکه', 'icon': '🎁', 'cost_coin': 500, 'cost_gem': 0, 'loot': [
+        {'weight': 1, 'coins': (100, 2000)}
+    ]},
+    'zp': {'name': 'باکس ZP', 'icon': '🎁', 'cost_coin': 1000, 'cost_gem': 0, 'loot': [
+        {'weight': 1, 'zp': (50, 500)}
+    ]},
+    'special': {'name': 'باکس ویژه', 'icon': '💎', 'cost_coin': 0, 'cost_gem': 5, 'loot': [
+        {'weight': 1, 'missile': 'شهاب (Meteor)'},
+        {'weight': 1, 'missile': 'سیل (Tsunami)'},
+        {'weight': 1, 'missile': 'توفان (Storm)'}
+    ]},
+    'legendary': {'name': 'باکس افسانه‌ای', 'icon': '👑', 'cost_coin': 0, 'cost_gem': 10, 'loot': [
+        {'weight': 9, 'coins': (1000, 10000)},
+        {'weight': 1, 'coins': (5000, 20000), 'jackpot': True}  # 10% شانس جکپات
+    ]},
+    'free': {'name': 'باکس رایگان', 'icon': '🆓', 'cost_coin': 0, 'cost_gem': 0, 'cooldown': 86400, 'loot': [  # 24 ساعت
+        {'weight': 1, 'coins': (10, 100)},
+        {'weight': 1, 'zp': (10, 100)}
+    ]}
+}
+
+# نمونه‌گیرهای alias یک بار هنگام بارگذاری ساخته می‌شوند
+LOOT_TABLES = {box_type: LootTable(box['loot']) for box_type, box in BOX_DATA.items()}
+# باز کردن چندتایی (فقط باکس‌های پولی)
+BOX_BULK_COUNTS = (10, 100)
+BOX_BULK_TYPES = tuple(box_type for box_type in BOX_DATA if box_type != 'free')
+
+def box_price_text(box: dict):
+    prices = []
+    if box['cost_coin']:
+        prices.append(f"{box['cost_coin']:,} ZC")
+    if box['cost_gem']:
+        prices.append(f"{box['cost_gem']:,} ZG")
+    return " + ".join(prices) or "رایگان"
+
 MINER_LEVELS = {
     1: {'zp_per_hour': 100, 'upgrade_cost': 100},
     2: {'zp_per_hour': 200, 'upgrade_cost': 200},
@@ -337,45 +1975,442 @@ MINER_LEVELS = {
     15: {'zp_per_hour': 1500, 'upgrade_cost': 50000}
 }
 
+# سیستم دفاع -> ستون لول در جدول users
+DEFENSE_COLUMNS = {
+    'missile': 'defense_missile_level',
+    'electronic': 'defense_electronic_level',
+    'antifighter': 'defense_antifighter_level'
+}
+# نام، آیکون، ضریب هزینه (ارتقا از لول L: (L + 1) × cost) و بانس هر لول به درصد
+DEFENSE_SYSTEMS = {
+    'missile': {'name': "دفاع موشکی", 'icon': "🚀", 'cost': 1000, 'bonus': 5},
+    'electronic': {'name': "جنگ الکترونیک", 'icon': "📡", 'cost': 800, 'bonus': 3},
+    'antifighter': {'name': "ضد جنگنده", 'icon': "✈️", 'cost': 1200, 'bonus': 7}
+}
+DEFENSE_BONUS_CAP = 50  # درصد
+DEFENSE_BONUS_SQL = 'MIN({}, {}) / 100.0'.format(
+    ' + '.join(f"{DEFENSE_COLUMNS[name]} * {system['bonus']}" for name, system in DEFENSE_SYSTEMS.items()),
+    DEFENSE_BONUS_CAP
+)
+# ستون‌هایی که spend_and_grant اجازه افزایش یا شرط روی آن‌ها را دارد
+UPGRADE_COLUMNS = {'miner_level', *DEFENSE_COLUMNS.values()}
+
+MINER_MAX_LEVEL = max(MINER_LEVELS)
+# جمع پیشوندی هزینه‌ها: هزینه ارتقا از لول a به b برابر MINER_COST_PREFIX[b] - MINER_COST_PREFIX[a]
+MINER_COST_PREFIX = [0, 0]
+for _level in range(1, MINER_MAX_LEVEL):
+    MINER_COST_PREFIX.append(MINER_COST_PREFIX[-1] + MINER_LEVELS[_level]['upgrade_cost'])
+
+def miner_upgrade_plan(user: dict, max_levels: Optional[int] = None):
+    """(تعداد لول، هزینه کل) بیشترین ارتقای قابل پرداخت، حداکثر max_levels لول (None = بدون محدودیت)"""
+    level = user['miner_level']
+    target = bisect.bisect_right(MINER_COST_PREFIX, MINER_COST_PREFIX[level] + user['zone_coin']) - 1
+    target = min(target, MINER_MAX_LEVEL)
+    if max_levels is not None:
+        target = min(target, level + max_levels)
+    return target - level, MINER_COST_PREFIX[target] - MINER_COST_PREFIX[level]
+
+def defense_upgrade_plan(user: dict, defense_type: str, max_levels: Optional[int] = None):
+    """
+    (تعداد لول، هزینه کل) بیشترین ارتقای قابل پرداخت و مفید (تا رسیدن به سقف بانس)،
+    حداکثر max_levels لول (None = بدون محدودیت).
+    هزینه k لول از لول L سری حسابی است: cost × k(k + 2L + 1) / 2؛ k از حل معادله درجه دوم.
+    """
+    system = DEFENSE_SYSTEMS[defense_type]
+    level = user[DEFENSE_COLUMNS[defense_type]]
+    b = 2 * level + 1
+    affordable = (math.isqrt(b * b + 8 * (user['zone_coin'] // system['cost'])) - b) // 2
+    bonus = sum(user[DEFENSE_COLUMNS[name]] * other['bonus'] for name, other in DEFENSE_SYSTEMS.items())
+    useful = max(-(-(DEFENSE_BONUS_CAP - bonus) // system['bonus']), 0)
+    levels = min(affordable, useful)
+    if max_levels is not None:
+        levels = min(levels, max_levels)
+    return levels, system['cost'] * levels * (levels + b) // 2
+
+def miner_pending(level: int, since: int, now: int):
+    """ZP تولیدشده از since تا now؛ همین تابع در SQL برداشت (UDF) و پیش‌نمایش‌ها استفاده می‌شود"""
+    if since is None or now <= since:
+        return 0
+    return (now - since) * MINER_LEVELS[level]['zp_per_hour'] // 3600
+
+def miner_since(user: dict):
+    """شروع دوره تولید فعلی (معادل COALESCE(last_miner_claim, created_at))"""
+    return user['last_miner_claim'] if user['last_miner_claim'] is not None else user['created_at']
+
+# هدیه‌های همگانی (callback -> مقادیر)
+GLOBAL_GIFTS = {
+    'coins_1000': {'text': "1000 سکه", 'coins': 1000},
+    'gems_10': {'text': "10 جم", 'gems': 10},
+    'zp_500': {'text': "500 ZP", 'zp': 500},
+    'everything': {'text': "1000 سکه + 10 جم + 500 ZP", 'coins': 1000, 'gems': 10, 'zp': 500},
+    'missiles': {'text': "5 موشک شبح", 'missiles': {'شبح (Ghost)': 5}}
+}
+
+# فیلترهای هدیه همگانی (کد -> (متن، min_level، active_days))
+GIFT_FILTERS = {
+    'all': ("همه کاربران", None, None),
+    'l5': ("لول 5+", 5, None),
+    'l10': ("لول 10+", 10, None),
+    'a7': ("فعال 7 روز اخیر", None, 7),
+    'a30': ("فعال 30 روز اخیر", None, 30)
+}
+
+# === راه‌اندازی دیتابیس ===
+db = Database()
+adb = AsyncDatabase(db, workers=DB_WORKERS, queue_size=DB_QUEUE_SIZE)
+writer = GroupCommitWriter(adb, max_delay=WRITE_BATCH_DELAY_MS / 1000, max_batch=WRITE_BATCH_SIZE)
+attack_log = AttackLog(adb, capacity=ATTACK_LOG_BUFFER, batch_size=ATTACK_LOG_BATCH, interval=ATTACK_LOG_INTERVAL)
+storage = SQLiteStorage(adb, max_hot=FSM_HOT_SIZE, ttl=FSM_TTL, flush_interval=FSM_FLUSH_INTERVAL)
+user_locks = UserLocks(shards=USER_LOCK_SHARDS)
+throttle = Throttle(THROTTLE_LIMITS, THROTTLE_CLASSES)
+dp = Dispatcher(storage=storage)
+dp.message.middleware(throttle_middleware)
+dp.message.middleware(handler_metrics)
+dp.message.middleware(user_lock_middleware)
+
+@metrics.collector
+def runtime_metrics():
+    """وضعیت لحظه‌ای کش کاربران، group commit، لاگ حمله‌ها و FSM"""
+    cache, commits, log = db.cache.stats(), writer.stats(), attack_log.stats()
+    return [
+        ('warzone_user_cache_hits_total', 'counter', 'User cache hits', cache['hits']),
+        ('warzone_user_cache_misses_total', 'counter', 'User cache misses', cache['misses']),
+        ('warzone_user_cache_entries', 'gauge', 'Cached user rows', cache['users']),
+        ('warzone_write_batches_total', 'counter', 'Group commit batches', commits['batches']),
+        ('warzone_write_operations_total', 'counter', 'Operations applied by group commit', commits['operations']),
+        ('warzone_write_queue_size', 'gauge', 'Operations waiting for group commit', writer.queue.qsize()),
+        ('warzone_attack_log_pending', 'gauge', 'Attacks buffered in memory', log['pending']),
+        ('warzone_attack_log_dropped_total', 'counter', 'Attacks dropped from a full buffer', log['dropped']),
+        ('warzone_fsm_hot_entries', 'gauge', 'FSM states held in memory', len(storage.hot)),
+        ('warzone_fsm_dirty_entries', 'gauge', 'FSM states waiting for flush', len(storage.dirty)),
+        ('warzone_user_locks_active', 'gauge', 'Users with a held or awaited lock', len(user_locks)),
+        ('warzone_user_lock_contended_total', 'counter', 'Lock acquisitions that had to wait', user_locks.contended),
+        ('warzone_throttle_buckets', 'gauge', 'Per-user token buckets in memory', len(throttle))
+    ]
+
+# === کدک و مسیریاب callback ===
+# عملیات -> آرگومان‌ها: tuple (اندیس گزینه)، dict (کلید عددی -> مقدار) یا int (عدد مثبت).
+# شناسه هر عملیات ترتیب آن در این جدول است؛ عملیات جدید فقط به انتها اضافه شود.
+CALLBACK_SCHEMA = {
+    'back_to_main': (),
+    'attack': (tuple(ATTACK_TYPES),),
+    'quick_attack': (tuple(ATTACK_TYPES), int),
+    'market_special': (),
+    'market_normal': (),
+    'buy': (MISSILE_NAMES,),
+    'box': (tuple(BOX_DATA),),
+    'box_inventory': (),
+    'claim_miner': (),
+    'upgrade_miner': (),
+    'miner_info': (),
+    'upgrade_defense': (tuple(DEFENSE_COLUMNS),),
+    'defense_info': (),
+    'gift_filter': (tuple(GIFT_FILTERS),),
+    'gift_all': (tuple(GLOBAL_GIFTS), tuple(GIFT_FILTERS)),
+    'box_bulk': (BOX_BULK_TYPES, BOX_BULK_COUNTS),
+    'buy_qty': (MISSILE_NAMES, BUY_QUANTITIES),
+    'upgrade_miner_max': (),
+    'upgrade_defense_max': (tuple(DEFENSE_COLUMNS),),
+    'attack_history': ()
+}
+CALLBACK_VERSION = 1
+
+class CallbackCodec:
+    """
+    callback_data فشرده: base64 (url-safe، بدون padding) از
+    [نسخه][شناسه عملیات][آرگومان‌ها به صورت varint]
+    """
+
+    MAX_INT = 2 ** 63
+
+    def __init__(self, schema: dict, version: int):
+        self.version = version
+        self.actions = list(schema)
+        self.ids = {action: i for i, action in enumerate(self.actions)}
+        # برای هر عملیات: لیست (decode_map, encode_map) یا None برای int
+        self.specs = []
+        for action in self.actions:
+            specs = []
+            for spec in schema[action]:
+                if spec is int:
+                    specs.append(None)
+                    continue
+                decode_map = dict(spec) if isinstance(spec, dict) else dict(enumerate(spec))
+                specs.append((decode_map, {value: key for key, value in decode_map.items()}))
+            self.specs.append(specs)
+
+    def encode(self, action: str, *args) -> str:
+        action_id = self.ids[action]
+        specs = self.specs[action_id]
+        if len(args) != len(specs):
+            raise ValueError(f"Callback '{action}' expects {len(specs)} arguments")
+        raw = bytearray((self.version, action_id))
+        for spec, value in zip(specs, args):
+            self.write_varint(raw, value if spec is None else spec[1][value])
+        return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+    def decode(self, data: str):
+        """(عملیات، آرگومان‌ها)؛ برای داده نامعتبر یا نسخه دیگر ValueError"""
+        try:
+            raw = base64.b64decode(data + '=' * (-len(data) % 4), altchars=b'-_', validate=True)
+        except (ValueError, binascii.Error):
+            raise ValueError("Malformed callback data")
+        if len(raw) < 2 or raw[0] != self.version or raw[1] >= len(self.actions):
+            raise ValueError("Unknown callback version or action")
+        
+        action_id, pos, args = raw[1], 2, []
+        for spec in self.specs[action_id]:
+            value, pos = self.read_varint(raw, pos)
+            if spec is None:
+                if not 0 < value < self.MAX_INT:
+                    raise ValueError("Callback integer out of range")
+                args.append(value)
+            elif value in spec[0]:
+                args.append(spec[0][value])
+            else:
+                raise ValueError("Unknown callback choice")
+        if pos != len(raw):
+            raise ValueError("Trailing callback bytes")
+        return self.actions[action_id], tuple(args)
+
+    @staticmethod
+    def write_varint(raw: bytearray, value: int):
+        while value >= 0x80:
+            raw.append(value & 0x7F | 0x80)
+            value >>= 7
+        raw.append(value)
+
+    @staticmethod
+    def read_varint(raw: bytes, pos: int):
+        value = shift = 0
+        while True:
+            if pos >= len(raw) or shift > 63:
+                raise ValueError("Truncated callback integer")
+            byte = raw[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, pos
+            shift += 7
+
+class CallbackRouter:
+    """یک بار decode و مسیریابی O(1) از جدول عملیات -> هندلر"""
+
+    def __init__(self, codec: CallbackCodec, locks: UserLocks, throttle: Throttle):
+        self.codec = codec
+        self.locks = locks
+        self.throttle = throttle
+        self.handlers = {}
+
+    def route(self, action: str, targets=None):
+        """targets: تابعی از آرگومان‌ها که کاربران دیگرِ نیازمند قفل را برمی‌گرداند (مثل هدف حمله)"""
+        if action not in self.codec.ids:
+            raise KeyError(f"Callback action '{action}' is not in CALLBACK_SCHEMA")
+        
+        def decorator(handler):
+            wants_state = 'state' in inspect.signature(handler).parameters
+            self.handlers[action] = (handler, wants_state, targets)
+            return handler
+        return decorator
+
+    async def dispatch(self, callback: CallbackQuery, state: FSMContext):
+        try:
+            action, args = self.codec.decode(callback.data or '')
+            handler, wants_state, targets = self.handlers[action]
+        except (ValueError, KeyError):
+            await callback.answer("❌ این دکمه منقضی شده است!")
+            return
+        
+        user_id = callback.from_user.id
+        if not is_admin(user_id) and not self.throttle.allow(user_id, self.throttle.action_class(handler.__name__)):
+            await callback.answer(THROTTLE_MESSAGE)
+            return
+        
+        user_ids = (user_id, *targets(*args)) if targets else (user_id,)
+        async with self.locks.hold(*user_ids):
+            # همه callbackها از همین هندلر عبور می‌کنند؛ زمان‌سنجی به نام هندلر واقعی
+            if wants_state:
+                await metrics.track(handler.__name__, handler(callback, *args, state=state))
+            else:
+                await metrics.track(handler.__name__, handler(callback, *args))
+
+callback_codec = CallbackCodec(CALLBACK_SCHEMA, CALLBACK_VERSION)
+callbacks = CallbackRouter(callback_codec, user_locks, throttle)
+cb_data = callback_codec.encode
+dp.callback_query.register(callbacks.dispatch)
+
 # === توابع کمکی ===
-def create_main_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👤 پروفایل"), KeyboardButton(text="⚔️ حمله")],
-            [KeyboardButton(text="🏪 بازار"), KeyboardButton(text="🎁 باکس")],
-            [KeyboardButton(text="⛏️ ماینر"), KeyboardButton(text="🏰 دفاع")],
-            [KeyboardButton(text="📊 رنکینگ"), KeyboardButton(text="📖 راهنما")]
-        ],
-        resize_keyboard=True,
-        input_field_placeholder="انتخاب کنید..."
-    )
-    return keyboard
-
-def create_admin_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👑 پنل ادمین")],
-            [KeyboardButton(text="📊 آمار کامل"), KeyboardButton(text="📢 پیام همگانی")],
-            [KeyboardButton(text="🎁 هدیه همگانی"), KeyboardButton(text="➕ سکه")],
-            [KeyboardButton(text="💎 جم"), KeyboardButton(text="⚡ ZP")],
-            [KeyboardButton(text="📈 تغییر لول"), KeyboardButton(text="🔙 بازگشت")]
-        ],
-        resize_keyboard=True,
-        input_field_placeholder="دستور ادمین..."
-    )
-    return keyboard
+def create_global_gift_keyboard(gift_filter: str = 'all'):
+    """کیبورد هدیه همگانی با فیلتر انتخاب‌شده"""
+    filter_buttons = [
+        InlineKeyboardButton(
+            text=f"{'✅ ' if code == gift_filter else ''}{label}",
+            callback_data=cb_data('gift_filter', code)
+        )
+        for code, (label, _, _) in GIFT_FILTERS.items()
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💰 1000 سکه", callback_data=cb_data('gift_all', 'coins_1000', gift_filter))],
+        [InlineKeyboardButton(text="💎 10 جم", callback_data=cb_data('gift_all', 'gems_10', gift_filter))],
+        [InlineKeyboardButton(text="⚡ 500 ZP", callback_data=cb_data('gift_all', 'zp_500', gift_filter))],
+        [InlineKeyboardButton(text="🎁 همه موارد بالا", callback_data=cb_data('gift_all', 'everything', gift_filter))],
+        [InlineKeyboardButton(text="💣 5 موشک شبح", callback_data=cb_data('gift_all', 'missiles', gift_filter))],
+        filter_buttons[:3],
+        filter_buttons[3:]
+    ])
 
 def is_admin(user_id: int):
     """بررسی ادمین بودن کاربر"""
     return user_id in ADMIN_IDS
 
-def get_defense_bonus(defense_levels):
-    """محاسبه بانس دفاع"""
-    total_bonus = 0
-    total_bonus += defense_levels.get('missile', 0) * 0.05
-    total_bonus += defense_levels.get('electronic', 0) * 0.03
-    total_bonus += defense_levels.get('antifighter', 0) * 0.07
-    return min(total_bonus, 0.5)  # حداکثر 50% بانس
+# === کش رندر (کیبوردها و متن‌های ثابت) ===
+# همه markupها و بخش‌های ثابت متن‌ها یک بار از داده‌های بازی ساخته می‌شوند؛
+# هندلرها فقط فیلدهای مخصوص کاربر را پر می‌کنند.
+
+def button_rows(buttons, size: int = 2):
+    """چیدن دکمه‌ها در ردیف‌های size تایی"""
+    return [buttons[i:i + size] for i in range(0, len(buttons), size)]
+
+BACK_BUTTON = InlineKeyboardButton(text="🔙 بازگشت", callback_data=cb_data('back_to_main'))
+
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="👤 پروفایل"), KeyboardButton(text="⚔️ حمله")],
+        [KeyboardButton(text="🏪 بازار"), KeyboardButton(text="🎁 باکس")],
+        [KeyboardButton(text="⛏️ ماینر"), KeyboardButton(text="🏰 دفاع")],
+        [KeyboardButton(text="📊 رنکینگ"), KeyboardButton(text="📖 راهنما")]
+    ],
+    resize_keyboard=True,
+    input_field_placeholder="انتخاب کنید..."
+)
+
+ADMIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="👑 پنل ادمین")],
+        [KeyboardButton(text="📊 آمار کامل"), KeyboardButton(text="📢 پیام همگانی")],
+        [KeyboardButton(text="🎁 هدیه همگانی"), KeyboardButton(text="➕ سکه")],
+        [KeyboardButton(text="💎 جم"), KeyboardButton(text="⚡ ZP")],
+        [KeyboardButton(text="📈 تغییر لول"), KeyboardButton(text="🔙 بازگشت")]
+    ],
+    resize_keyboard=True,
+    input_field_placeholder="دستور ادمین..."
+)
+
+GIFT_KEYBOARDS = {code: create_global_gift_keyboard(code) for code in GIFT_FILTERS}
+
+# منوی حمله
+ATTACK_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=button_rows([
+    InlineKeyboardButton(
+        text=f"{combo_name} ({ATTACK_COMBOS[combo_name]['multiplier']:g}x)",
+        callback_data=cb_data('attack', attack_type)
+    )
+    for attack_type, combo_name in ATTACK_TYPES.items()
+]) + [
+    [InlineKeyboardButton(text="📜 حمله‌های اخیر", callback_data=cb_data('attack_history'))],
+    [BACK_BUTTON]
+])
+
+ATTACK_MENU_TEXT = "\n⚔️ <b>انتخاب نوع حمله:</b>\n━━━━━━━━━━━━━━\n" + "\n   \n".join(
+    f"{i}. {combo_name}\n   • ضریب: {ATTACK_COMBOS[combo_name]['multiplier']:g}x\n"
+    f"   • {ATTACK_COMBOS[combo_name]['description']}"
+    for i, combo_name in enumerate(ATTACK_TYPES.values(), 1)
+) + "\n    "
+
+# بازار
+NORMAL_MISSILES = [name for name, data in MISSILE_DATA.items() if data['type'] == 'normal']
+SPECIAL_MISSILES = [name for name, data in MISSILE_DATA.items() if data['type'] == 'special']
+
+def missile_row(name: str):
+    """نام موشک (خرید ×1) و دکمه‌های ×5 / ×10 / حداکثر"""
+    return [InlineKeyboardButton(text=name, callback_data=cb_data('buy', name))] + [
+        InlineKeyboardButton(
+            text="حداکثر" if quantity == 'max' else f"×{quantity}",
+            callback_data=cb_data('buy_qty', name, quantity)
+        )
+        for quantity in BUY_QUANTITIES[1:]
+    ]
+
+SPECIAL_PAGE_BUTTON = InlineKeyboardButton(text="⏩ موشک‌های ویژه", callback_data=cb_data('market_special'))
+NORMAL_PAGE_BUTTON = InlineKeyboardButton(text="⏪ موشک‌های معمولی", callback_data=cb_data('market_normal'))
+
+MARKET_NORMAL_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    missile_row(name) for name in NORMAL_MISSILES
+] + [[SPECIAL_PAGE_BUTTON]])
+MARKET_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=MARKET_NORMAL_KEYBOARD.inline_keyboard + [[BACK_BUTTON]])
+MARKET_SPECIAL_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    missile_row(name) for name in SPECIAL_MISSILES
+] + [[NORMAL_PAGE_BUTTON]])
+
+NORMAL_MISSILES_TEXT = "\n\n".join(
+    f"{i}. {name}\n   • قدرت: {MISSILE_DATA[name]['damage']} آسیب\n"
+    f"   • قیمت: {MISSILE_DATA[name]['price']} ZC\n   • نیاز لول: {MISSILE_DATA[name]['min_level']}"
+    for i, name in enumerate(NORMAL_MISSILES, 1)
+)
+NORMAL_MISSILES_SHORT = "\n".join(
+    f"{i}. {name} - {MISSILE_DATA[name]['price']} ZC" for i, name in enumerate(NORMAL_MISSILES, 1)
+)
+SPECIAL_MISSILES_TEXT = "\n\n".join(
+    f"{i}. {name}\n   • قدرت: {MISSILE_DATA[name]['damage']} آسیب\n"
+    f"   • قیمت: {MISSILE_DATA[name]['price']:,} ZC + {MISSILE_DATA[name]['gem_cost']} جم\n"
+    f"   • نیاز لول: {MISSILE_DATA[name]['min_level']}"
+    for i, name in enumerate(SPECIAL_MISSILES, 1)
+)
+
+# باکس‌ها
+BOX_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=button_rows([
+    InlineKeyboardButton(
+        text=f"{box['icon']} {box['name']}" + (f" ({box_price_text(box)})" if box['cost_coin'] or box['cost_gem'] else ""),
+        callback_data=cb_data('box', box_type)
+    )
+    for box_type, box in BOX_DATA.items()
+] + [InlineKeyboardButton(text="📦 موجودی باکس‌ها", callback_data=cb_data('box_inventory'))]) + [[BACK_BUTTON]])
+
+BOX_MENU_TEXT = "\n   \n".join(
+    f"{i}. {box['icon']} <b>{box['name']}</b>\n"
+    f"   • قیمت: {box_price_text(box)}\n"
+    f"   • جایزه: {LOOT_TABLES[box_type].describe()}"
+    + (f"\n   • بازدید بعدی: {box['cooldown'] // 3600} ساعت بعد" if 'cooldown' in box else "")
+    for i, (box_type, box) in enumerate(BOX_DATA.items(), 1)
+)
+
+# بعد از باز کردن: دوباره ×1 / ×10 / ×100 از همان باکس
+BOX_RESULT_KEYBOARDS = {
+    box_type: InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔁 ×1", callback_data=cb_data('box', box_type))] + [
+            InlineKeyboardButton(text=f"🎁 ×{count}", callback_data=cb_data('box_bulk', box_type, count))
+            for count in BOX_BULK_COUNTS
+        ],
+        [BACK_BUTTON]
+    ])
+    for box_type in BOX_BULK_TYPES
+}
+BOX_RESULT_KEYBOARDS['free'] = InlineKeyboardMarkup(inline_keyboard=[[BACK_BUTTON]])
+
+# ماینر و دفاع
+MINER_INFO_ROW = [InlineKeyboardButton(text="📊 اطلاعات ماینر", callback_data=cb_data('miner_info'))]
+MINER_UPGRADE_ROWS = {
+    level: [
+        InlineKeyboardButton(text=f"⬆️ ارتقا به لول {level + 1}", callback_data=cb_data('upgrade_miner')),
+        InlineKeyboardButton(text="⏫ حداکثر ارتقا", callback_data=cb_data('upgrade_miner_max'))
+    ]
+    for level in MINER_LEVELS if level + 1 in MINER_LEVELS
+}
+
+DEFENSE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="🚀 دفاع موشکی", callback_data=cb_data('upgrade_defense', 'missile')),
+        InlineKeyboardButton(text="📡 جنگ الکترونیک", callback_data=cb_data('upgrade_defense', 'electronic'))
+    ],
+    [
+        InlineKeyboardButton(text="✈️ ضد جنگنده", callback_data=cb_data('upgrade_defense', 'antifighter')),
+        InlineKeyboardButton(text="📊 اطلاعات دفاع", callback_data=cb_data('defense_info'))
+    ],
+    [
+        InlineKeyboardButton(text=f"⏫ {system['icon']}", callback_data=cb_data('upgrade_defense_max', defense_type))
+        for defense_type, system in DEFENSE_SYSTEMS.items()
+    ],
+    [BACK_BUTTON]
+])
 
 # === هندلرهای اصلی ===
 @dp.message(CommandStart())
@@ -385,7 +2420,7 @@ async def cmd_start(message: Message):
     full_name = message.from_user.full_name
     
     # ثبت کاربر
-    db.register_user(user_id, username, full_name)
+    await adb.register_user(user_id, username, full_name)
     
     welcome_text = f"""
 🚀 <b>به جنگ‌افزار خوش آمدید {full_name}!</b>
@@ -409,26 +2444,22 @@ async def cmd_start(message: Message):
 📖 برای شروع از دکمه‌های زیر استفاده کنید:
     """
     
-    await message.answer(welcome_text, reply_markup=create_main_keyboard())
+    await message.answer(welcome_text, reply_markup=MAIN_KEYBOARD)
 
 @dp.message(F.text == "👤 پروفایل")
 async def cmd_profile(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
     # محاسبه ZP قابل دریافت از ماینر
-    miner_zp = 0
-    if user['last_miner_claim']:
-        time_passed = int(time.time()) - user['last_miner_claim']
-        zp_per_hour = MINER_LEVELS[user['miner_level']]['zp_per_hour']
-        miner_zp = int((time_passed / 3600) * zp_per_hour)
+    miner_zp = miner_pending(user['miner_level'], miner_since(user), int(time.time()))
     
     # دریافت موشک‌ها
-    missiles = db.get_user_missiles(user_id)
+    missiles = await adb.get_user_missiles(user_id)
     missiles_text = ""
     if missiles:
         for missile in missiles[:5]:  # فقط 5 موشک اول
@@ -469,59 +2500,17 @@ async def cmd_profile(message: Message):
 @dp.message(F.text == "⚔️ حمله")
 async def cmd_attack(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
-    # ایجاد کیبورد برای انتخاب نوع حمله
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="حمله ساده (1x)", callback_data="attack_simple"),
-            InlineKeyboardButton(text="حمله متوسط (1.5x)", callback_data="attack_medium")
-        ],
-        [
-            InlineKeyboardButton(text="حمله پیشرفته (2x)", callback_data="attack_advanced"),
-            InlineKeyboardButton(text="حمله ویرانگر (5x)", callback_data="attack_nuclear")
-        ],
-        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")]
-    ])
-    
-    attack_info = """
-⚔️ <b>انتخاب نوع حمله:</b>
-━━━━━━━━━━━━━━
-1. حمله ساده
-   • ضریب: 1x
-   • نیاز: 1 موشک شبح (Ghost)
-   
-2. حمله متوسط  
-   • ضریب: 1.5x
-   • نیاز: 1 موشک رعد (Thunder)
-   
-3. حمله پیشرفته
-   • ضریب: 2x
-   • نیاز: 1 موشک تندر (Boomer)
-   
-4. حمله ویرانگر
-   • ضریب: 5x
-   • نیاز: 1 موشک آپوکالیپس + 10 جم
-    """
-    
-    await message.answer(attack_info, reply_markup=keyboard)
+    await message.answer(ATTACK_MENU_TEXT, reply_markup=ATTACK_KEYBOARD)
 
-@dp.callback_query(F.data.startswith("attack_"))
-async def process_attack_type(callback: CallbackQuery, state: FSMContext):
-    attack_type = callback.data.replace("attack_", "")
-    
-    attack_map = {
-        'simple': 'حمله ساده',
-        'medium': 'حمله متوسط',
-        'advanced': 'حمله پیشرفته',
-        'nuclear': 'حمله ویرانگر'
-    }
-    
-    attack_name = attack_map.get(attack_type)
+@callbacks.route('attack')
+async def process_attack_type(callback: CallbackQuery, attack_type: str, state: FSMContext):
+    attack_name = ATTACK_TYPES.get(attack_type)
     
     # ذخیره نوع حمله
     await state.update_data(attack_type=attack_type, attack_name=attack_name)
@@ -558,7 +2547,7 @@ async def cmd_attack_reply(message: Message, state: FSMContext):
     
     # دریافت اطلاعات حمله‌کننده
     attacker_id = message.from_user.id
-    attacker = db.get_user(attacker_id)
+    attacker = await adb.get_user(attacker_id)
     
     if not attacker:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
@@ -574,7 +2563,7 @@ async def cmd_attack_reply(message: Message, state: FSMContext):
         return
     
     # بررسی وجود هدف در دیتابیس
-    target = db.get_user(target_id)
+    target = await adb.get_user(target_id)
     if not target:
         await message.answer("❌ کاربر هدف در ربات ثبت‌نام نکرده است!")
         return
@@ -582,12 +2571,12 @@ async def cmd_attack_reply(message: Message, state: FSMContext):
     # درخواست نوع حمله
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="حمله ساده", callback_data=f"quick_attack_simple_{target_id}"),
-            InlineKeyboardButton(text="حمله متوسط", callback_data=f"quick_attack_medium_{target_id}")
+            InlineKeyboardButton(text="حمله ساده", callback_data=cb_data('quick_attack', 'simple', target_id)),
+            InlineKeyboardButton(text="حمله متوسط", callback_data=cb_data('quick_attack', 'medium', target_id))
         ],
         [
-            InlineKeyboardButton(text="حمله پیشرفته", callback_data=f"quick_attack_advanced_{target_id}"),
-            InlineKeyboardButton(text="حمله ویرانگر", callback_data=f"quick_attack_nuclear_{target_id}")
+            InlineKeyboardButton(text="حمله پیشرفته", callback_data=cb_data('quick_attack', 'advanced', target_id)),
+            InlineKeyboardButton(text="حمله ویرانگر", callback_data=cb_data('quick_attack', 'nuclear', target_id))
         ]
     ])
     
@@ -600,15 +2589,10 @@ async def cmd_attack_reply(message: Message, state: FSMContext):
 📊 <b>انتخاب نوع حمله:</b>
     """, reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("quick_attack_"))
-async def process_quick_attack(callback: CallbackQuery):
+@callbacks.route('quick_attack', targets=lambda attack_type, target_id: (target_id,))
+async def process_quick_attack(callback: CallbackQuery, attack_type: str, target_id: int):
     """پردازش حمله سریع"""
     try:
-        # استخراج اطلاعات از callback_data
-        parts = callback.data.split("_")
-        attack_type = parts[2]  # simple, medium, advanced, nuclear
-        target_id = int(parts[3])
-        
         attacker_id = callback.from_user.id
         
         # انجام حمله
@@ -619,110 +2603,59 @@ async def process_quick_attack(callback: CallbackQuery):
         logger.error(f"Quick attack error: {e}")
         await callback.answer("❌ خطا در انجام حمله!")
 
+@metrics.timed
 async def execute_attack(attacker_id: int, target_id: int, attack_type: str, message_obj):
     """انجام حمله"""
-    attacker = db.get_user(attacker_id)
-    target = db.get_user(target_id)
+    result = await adb.resolve_attack(attacker_id, target_id, attack_type)
     
-    if not attacker or not target:
+    error = result.get('error')
+    if error == 'not_found':
         await message_obj.answer("❌ کاربر یافت نشد!")
         return
-    
-    # بررسی حمله به خود
-    if attacker_id == target_id:
+    if error == 'self':
         await message_obj.answer("❌ نمی‌توانید به خود حمله کنید!")
         return
-    
-    # انتخاب combo
-    combo_map = {
-        'simple': ATTACK_COMBOS['حمله ساده'],
-        'medium': ATTACK_COMBOS['حمله متوسط'],
-        'advanced': ATTACK_COMBOS['حمله پیشرفته'],
-        'nuclear': ATTACK_COMBOS['حمله ویرانگر']
-    }
-    
-    combo = combo_map.get(attack_type)
-    
-    if not combo:
+    if error == 'invalid_type':
         await message_obj.answer("❌ نوع حمله نامعتبر!")
         return
-    
-    # بررسی سطح
-    if attacker['level'] < combo['min_level']:
-        await message_obj.answer(f"❌ برای این حمله حداقل لول {combo['min_level']} نیاز دارید!")
+    if error == 'min_level':
+        await message_obj.answer(f"❌ برای این حمله حداقل لول {result['required']} نیاز دارید!")
+        return
+    if error == 'missile':
+        await message_obj.answer(f"❌ {result['missile']} کافی ندارید! (نیاز: {result['required']})")
+        return
+    if error == 'gem':
+        await message_obj.answer(f"❌ جم کافی ندارید! (نیاز: {result['required']})")
         return
     
-    # بررسی نیازمندی‌ها
-    for req, amount in combo['requirements'].items():
-        if req in MISSILE_DATA:
-            # بررسی موشک
-            missiles = db.get_user_missiles(attacker_id)
-            missile_qty = next((m['quantity'] for m in missiles if m['missile_name'] == req), 0)
-            if missile_qty < amount:
-                await message_obj.answer(f"❌ {req} کافی ندارید! (نیاز: {amount})")
-                return
-        elif req == 'zone_gem':
-            if attacker['zone_gem'] < amount:
-                await message_obj.answer(f"❌ جم کافی ندارید! (نیاز: {amount})")
-                return
-    
-    # محاسبه خسارت با در نظر گرفتن دفاع
-    base_damage = 100 + (attacker['level'] * 10)
-    actual_damage = int(base_damage * combo['multiplier'] * (1 - target['total_defense_bonus']))
-    
-    # محاسبه غنیمت (حداکثر 15% از دارایی هدف)
-    loot_coins = min(int(target['zone_coin'] * 0.15), 5000)
-    loot_gems = min(int(target['zone_gem'] * 0.10), 50)
-    
-    # کسر منابع از هدف (حداقل صفر)
-    new_target_coins = max(target['zone_coin'] - loot_coins, 0)
-    new_target_gems = max(target['zone_gem'] - loot_gems, 0)
-    
-    db.update_user_coins(target_id, -loot_coins)
-    db.update_user_gems(target_id, -loot_gems)
-    
-    # اضافه کردن منابع به حمله‌کننده
-    db.update_user_coins(attacker_id, loot_coins)
-    db.update_user_gems(attacker_id, loot_gems)
-    
-    # کسر موشک‌ها
-    for req, amount in combo['requirements'].items():
-        if req in MISSILE_DATA:
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-            UPDATE user_missiles 
-            SET quantity = quantity - ? 
-            WHERE user_id = ? AND missile_name = ?
-            ''', (amount, attacker_id, req))
-            conn.commit()
-            conn.close()
+    attack_log.record(attacker_id, target_id, attack_type,
+                      result['damage'], result['loot_coins'], result['loot_gems'])
     
-    # اضافه کردن XP
-    level_up, new_level = db.add_xp(attacker_id, 50)
+    # XP حمله بدون شرط است و با بقیه تغییرات کوچک گروهی commit می‌شود
+    result['level_up'], result['new_level'] = await writer.add(attacker_id, xp=ATTACK_XP)
+    if result['level_up']:
+        # جایزه افزایش لول در موجودی گزارش
+        attacker = await adb.get_user(attacker_id)
+        result['attacker_coins'], result['attacker_gems'] = attacker['zone_coin'], attacker['zone_gem']
     
     # ارسال گزارش به حمله‌کننده
-    attack_names = {
-        'simple': 'حمله ساده',
-        'medium': 'حمله متوسط',
-        'advanced': 'حمله پیشرفته',
-        'nuclear': 'حمله ویرانگر'
-    }
-    
     report_text = f"""
 🎯 <b>حمله موفق!</b>
 ━━━━━━━━━━━━━━
-⚔️ حمله‌کننده: {attacker['full_name']}
-🎯 هدف: {target['full_name']}
-💥 نوع حمله: {attack_names[attack_type]}
-🛡️ کاهش بانس دفاع: {target['total_defense_bonus']*100:.1f}%
-💢 خسارت وارد شده: {actual_damage}
+⚔️ حمله‌کننده: {result['attacker_name']}
+🎯 هدف: {result['target_name']}
+💥 نوع حمله: {result['attack_name']}
+🛡️ کاهش بانس دفاع: {result['defense_bonus']*100:.1f}%
+💢 خسارت وارد شده: {result['damage']}
 ━━━━━━━━━━━━━━
-💰 غنیمت سکه: {loot_coins} ZC
-💎 غنیمت جم: {loot_gems} ZG
+💰 غنیمت سکه: {result['loot_coins']} ZC
+💎 غنیمت جم: {result['loot_gems']} ZG
 ━━━━━━━━━━━━━━
-⭐ XP کسب شده: 50
-{'🎉 سطح شما افزایش یافت!' if level_up else ''}
+⭐ XP کسب شده: {result['xp']}
+{f"🎉 سطح شما افزایش یافت! (لول {result['new_level']})" if result['level_up'] else ''}
+📊 موجودی جدید:
+• سکه: {result['attacker_coins']} ZC
+• جم: {result['attacker_gems']} ZG
     """
     
     await message_obj.answer(report_text)
@@ -732,49 +2665,58 @@ async def execute_attack(attacker_id: int, target_id: int, attack_type: str, mes
         target_report = f"""
 🚨 <b>تحت حمله قرار گرفتید!</b>
 ━━━━━━━━━━━━━━
-⚔️ حمله‌کننده: {attacker['full_name']}
-💢 خسارت: {actual_damage}
-💰 سکه از دست رفته: {loot_coins}
-💎 جم از دست رفته: {loot_gems}
-🛡️ دفاع شما {target['total_defense_bonus']*100:.1f}% خسارت را کاهش داد
+⚔️ حمله‌کننده: {result['attacker_name']}
+💢 خسارت: {result['damage']}
+💰 سکه از دست رفته: {result['loot_coins']}
+💎 جم از دست رفته: {result['loot_gems']}
+🛡️ دفاع شما {result['defense_bonus']*100:.1f}% خسارت را کاهش داد
 📊 موجودی جدید:
-• سکه: {new_target_coins} ZC
-• جم: {new_target_gems} ZG
+• سکه: {result['target_coins']} ZC
+• جم: {result['target_gems']} ZG
         """
         await bot.send_message(target_id, target_report)
     except Exception as e:
         logger.error(f"Failed to send attack report to target: {e}")
 
+@callbacks.route('attack_history')
+async def cmd_attack_history(callback: CallbackQuery):
+    """آخرین حمله‌های کاربر از بافر AttackLog و جدول attacks"""
+    user_id = callback.from_user.id
+    attacks = await attack_log.history(user_id, limit=10)
+    
+    if not attacks:
+        await callback.answer("📜 هنوز حمله‌ای ثبت نشده است!")
+        return
+    
+    lines = []
+    for attack in attacks:
+        time_text = datetime.fromtimestamp(attack['timestamp']).strftime('%m/%d %H:%M')
+        attack_name = ATTACK_TYPES.get(attack['attack_type'], attack['attack_type'])
+        if attack['attacker_id'] == user_id:
+            lines.append(f"⚔️ {time_text} | {attack_name} به <code>{attack['target_id']}</code>\n"
+                         f"   💢 {attack['damage']} | 💰 +{attack['loot_coins']} | 💎 +{attack['loot_gems']}")
+        else:
+            lines.append(f"🚨 {time_text} | {attack_name} از <code>{attack['attacker_id']}</code>\n"
+                         f"   💢 {attack['damage']} | 💰 -{attack['loot_coins']} | 💎 -{attack['loot_gems']}")
+    
+    history_text = "\n📜 <b>حمله‌های اخیر</b>\n━━━━━━━━━━━━━━\n" + "\n".join(lines)
+    
+    await callback.message.edit_text(history_text, reply_markup=ATTACK_KEYBOARD)
+    await callback.answer()
+
 @dp.message(F.text == "🏪 بازار")
 async def cmd_market(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
     # دریافت موشک‌های کاربر
-    user_missiles = db.get_user_missiles(user_id)
+    user_missiles = await adb.get_user_missiles(user_id)
     user_missiles_dict = {m['missile_name']: m['quantity'] for m in user_missiles}
     
-    # ایجاد کیبورد برای بازار
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="شبح (Ghost)", callback_data="buy_ghost"),
-            InlineKeyboardButton(text="رعد (Thunder)", callback_data="buy_thunder")
-        ],
-        [
-            InlineKeyboardButton(text="تندر (Boomer)", callback_data="buy_boomer"),
-            InlineKeyboardButton(text="هاوک (Hawk)", callback_data="buy_hawk")
-        ],
-        [
-            InlineKeyboardButton(text="پاتریوت (Patriot)", callback_data="buy_patriot"),
-            InlineKeyboardButton(text="⏩ موشک‌های ویژه", callback_data="market_special")
-        ],
-        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")]
-    ])
-    
     # نمایش موجودی موشک‌ها
     missiles_text = ""
     common_missiles = ['شبح (Ghost)', 'رعد (Thunder)', 'تندر (Boomer)']
@@ -794,53 +2736,17 @@ async def cmd_market(message: Message):
 ━━━━━━━━━━━━━━
 📦 <b>موشک‌های معمولی:</b>
 
-1. شبح (Ghost)
-   • قدرت: 50 آسیب
-   • قیمت: 200 ZC
-   • نیاز لول: 1
-
-2. رعد (Thunder)
-   • قدرت: 70 آسیب  
-   • قیمت: 500 ZC
-   • نیاز لول: 2
-
-3. تندر (Boomer)
-   • قدرت: 90 آسیب
-   • قیمت: 1000 ZC
-   • نیاز لول: 3
-
-4. هاوک (Hawk)
-   • قدرت: 110 آسیب
-   • قیمت: 2000 ZC
-   • نیاز لول: 4
-
-5. پاتریوت (Patriot)
-   • قدرت: 130 آسیب
-   • قیمت: 5000 ZC
-   • نیاز لول: 5
+{NORMAL_MISSILES_TEXT}
+━━━━━━━━━━━━━━
+🔢 خرید چندتایی: ×5، ×10 یا حداکثر تعداد قابل پرداخت
     """
     
-    await message.answer(market_text, reply_markup=keyboard)
+    await message.answer(market_text, reply_markup=MARKET_KEYBOARD)
 
-@dp.callback_query(F.data == "market_special")
+@callbacks.route('market_special')
 async def cmd_market_special(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="شهاب (Meteor)", callback_data="buy_meteor"),
-            InlineKeyboardButton(text="سیل (Tsunami)", callback_data="buy_tsunami")
-        ],
-        [
-            InlineKeyboardButton(text="توفان (Storm)", callback_data="buy_storm"),
-            InlineKeyboardButton(text="تایفون (Typhoon)", callback_data="buy_typhoon")
-        ],
-        [
-            InlineKeyboardButton(text="آپوکالیپس (Apocalypse)", callback_data="buy_apocalypse"),
-            InlineKeyboardButton(text="⏪ موشک‌های معمولی", callback_data="market_normal")
-        ]
-    ])
+    user = await adb.get_user(user_id)
     
     special_text = f"""
 💎 <b>موشک‌های ویژه</b>
@@ -851,53 +2757,17 @@ async def cmd_market_special(callback: CallbackQuery):
 ━━━━━━━━━━━━━━
 💣 <b>موشک‌های ویژه:</b>
 
-1. شهاب (Meteor)
-   • قدرت: 250 آسیب
-   • قیمت: 25,000 ZC + 1 جم
-   • نیاز لول: 6
-
-2. سیل (Tsunami)
-   • قدرت: 300 آسیب
-   • قیمت: 30,000 ZC + 2 جم
-   • نیاز لول: 7
-
-3. توفان (Storm)
-   • قدرت: 350 آسیب  
-   • قیمت: 35,000 ZC + 3 جم
-   • نیاز لول: 8
-
-4. تایفون (Typhoon)
-   • قدرت: 400 آسیب
-   • قیمت: 40,000 ZC + 4 جم
-   • نیاز لول: 9
-
-5. آپوکالیپس (Apocalypse)
-   • قدرت: 500 آسیب
-   • قیمت: 50,000 ZC + 5 جم
-   • نیاز لول: 10
+{SPECIAL_MISSILES_TEXT}
+━━━━━━━━━━━━━━
+🔢 خرید چندتایی: ×5، ×10 یا حداکثر تعداد قابل پرداخت
     """
     
-    await callback.message.edit_text(special_text, reply_markup=keyboard)
+    await callback.message.edit_text(special_text, reply_markup=MARKET_SPECIAL_KEYBOARD)
 
-@dp.callback_query(F.data == "market_normal")
+@callbacks.route('market_normal')
 async def cmd_market_normal(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="شبح (Ghost)", callback_data="buy_ghost"),
-            InlineKeyboardButton(text="رعد (Thunder)", callback_data="buy_thunder")
-        ],
-        [
-            InlineKeyboardButton(text="تندر (Boomer)", callback_data="buy_boomer"),
-            InlineKeyboardButton(text="هاوک (Hawk)", callback_data="buy_hawk")
-        ],
-        [
-            InlineKeyboardButton(text="پاتریوت (Patriot)", callback_data="buy_patriot"),
-            InlineKeyboardButton(text="⏩ موشک‌های ویژه", callback_data="market_special")
-        ]
-    ])
+    user = await adb.get_user(user_id)
     
     market_text = f"""
 🏪 <b>بازار جنگ‌افزار</b>
@@ -908,40 +2778,21 @@ async def cmd_market_normal(callback: CallbackQuery):
 ━━━━━━━━━━━━━━
 📦 <b>موشک‌های معمولی:</b>
 
-1. شبح (Ghost) - 200 ZC
-2. رعد (Thunder) - 500 ZC  
-3. تندر (Boomer) - 1000 ZC
-4. هاوک (Hawk) - 2000 ZC
-5. پاتریوت (Patriot) - 5000 ZC
+{NORMAL_MISSILES_SHORT}
     """
     
-    await callback.message.edit_text(market_text, reply_markup=keyboard)
+    await callback.message.edit_text(market_text, reply_markup=MARKET_NORMAL_KEYBOARD)
 
-@dp.callback_query(F.data.startswith("buy_"))
-async def process_buy(callback: CallbackQuery):
-    missile_type = callback.data.replace("buy_", "")
-    
-    missile_map = {
-        # موشک‌های معمولی
-        'ghost': 'شبح (Ghost)',
-        'thunder': 'رعد (Thunder)',
-        'boomer': 'تندر (Boomer)',
-        'hawk': 'هاوک (Hawk)',
-        'patriot': 'پاتریوت (Patriot)',
-        
-        # موشک‌های ویژه
-        'meteor': 'شهاب (Meteor)',
-        'tsunami': 'سیل (Tsunami)',
-        'storm': 'توفان (Storm)',
-        'typhoon': 'تایفون (Typhoon)',
-        'apocalypse': 'آپوکالیپس (Apocalypse)'
-    }
-    
-    if missile_type not in missile_map:
-        await callback.answer("❌ این آیتم موجود نیست!")
-        return
-    
-    missile_name = missile_map[missile_type]
+@callbacks.route('buy')
+async def process_buy(callback: CallbackQuery, missile_name: str):
+    await buy_missile(callback, missile_name, 1)
+
+@callbacks.route('buy_qty')
+async def process_buy_quantity(callback: CallbackQuery, missile_name: str, quantity):
+    await buy_missile(callback, missile_name, None if quantity == 'max' else quantity)
+
+async def buy_missile(callback: CallbackQuery, missile_name: str, quantity: Optional[int]):
+    """خرید quantity موشک (None = حداکثر قابل پرداخت) با یک تراکنش"""
     missile_data = MISSILE_DATA.get(missile_name)
     
     if not missile_data:
@@ -949,85 +2800,66 @@ async def process_buy(callback: CallbackQuery):
         return
     
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
+    
+    if not user:
+        await callback.answer("❌ کاربر یافت نشد!")
+        return
     
     # بررسی سطح
     if user['level'] < missile_data['min_level']:
         await callback.answer(f"❌ نیاز به لول {missile_data['min_level']} دارید! (لول شما: {user['level']})")
         return
     
-    # بررسی موجودی سکه
-    if user['zone_coin'] < missile_data['price']:
-        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {missile_data['price']} ZC")
+    # بررسی موجودی سکه (برای حداکثر: حداقل یک عدد)
+    gem_cost = missile_data.get('gem_cost', 0)
+    count = quantity or 1
+    if user['zone_coin'] < missile_data['price'] * count:
+        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {missile_data['price'] * count:,} ZC")
         return
     
     # بررسی موجودی جم برای موشک‌های ویژه
-    if missile_data['type'] == 'special' and missile_data.get('gem_cost', 0) > 0:
-        if user['zone_gem'] < missile_data['gem_cost']:
-            await callback.answer(f"❌ جم کافی ندارید! نیاز: {missile_data['gem_cost']} جم")
-            return
+    if user['zone_gem'] < gem_cost * count:
+        await callback.answer(f"❌ جم کافی ندارید! نیاز: {gem_cost * count} جم")
+        return
     
-    # خرید
-    db.update_user_coins(user_id, -missile_data['price'])
+    # خرید و افزودن موشک (کسر شرطی هزینه و اعطا در یک تراکنش)
+    result = await adb.buy_missiles(user_id, missile_name, quantity)
     
-    if missile_data['type'] == 'special' and missile_data.get('gem_cost', 0) > 0:
-        db.update_user_gems(user_id, -missile_data['gem_cost'])
+    if not result:
+        await callback.answer("❌ موجودی کافی ندارید!")
+        return
     
-    # افزودن موشک
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    INSERT INTO user_missiles (user_id, missile_name, quantity)
-    VALUES (?, ?, 1)
-    ON CONFLICT(user_id, missile_name) 
-    DO UPDATE SET quantity = quantity + 1
-    ''', (user_id, missile_name))
-    conn.commit()
-    conn.close()
+    count, user = result
     
     # گزارش خرید
-    gem_text = f" + {missile_data['gem_cost']} جم" if missile_data.get('gem_cost', 0) > 0 else ""
+    gem_text = f" + {gem_cost * count} جم" if gem_cost > 0 else ""
     
     report_text = f"""
 ✅ <b>خرید موفق!</b>
 ━━━━━━━━━━━━━━
 📦 آیتم: {missile_name}
-💰 قیمت: {missile_data['price']} ZC{gem_text}
+🔢 تعداد: {count}
+💰 قیمت: {missile_data['price'] * count:,} ZC{gem_text}
 💥 قدرت: {missile_data['damage']} آسیب
 🎯 نیاز لول: {missile_data['min_level']}
 ━━━━━━━━━━━━━━
-💰 سکه باقی‌مانده: {user['zone_coin'] - missile_data['price']} ZC
-💎 جم باقی‌مانده: {user['zone_gem'] - missile_data.get('gem_cost', 0)} ZG
+💰 سکه باقی‌مانده: {user['zone_coin']} ZC
+💎 جم باقی‌مانده: {user['zone_gem']} ZG
     """
     
     await callback.message.edit_text(report_text)
-    await callback.answer("✅ خرید با موفقیت انجام شد!")
+    await callback.answer(f"✅ {count} عدد {missile_name} خریداری شد!")
 
 @dp.message(F.text == "🎁 باکس")
 async def cmd_boxes(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="🎁 باکس سکه (500 ZC)", callback_data="box_coin"),
-            InlineKeyboardButton(text="🎁 باکس ZP (1000 ZC)", callback_data="box_zp")
-        ],
-        [
-            InlineKeyboardButton(text="💎 باکس ویژه (5 ZG)", callback_data="box_special"),
-            InlineKeyboardButton(text="👑 باکس افسانه‌ای (10 ZG)", callback_data="box_legendary")
-        ],
-        [
-            InlineKeyboardButton(text="🆓 باکس رایگان", callback_data="box_free"),
-            InlineKeyboardButton(text="📦 موجودی باکس‌ها", callback_data="box_inventory")
-        ],
-        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")]
-    ])
-    
     box_text = f"""
 🎁 <b>فروشگاه باکس‌ها</b>
 ━━━━━━━━━━━━━━
@@ -1037,199 +2869,110 @@ async def cmd_boxes(message: Message):
 ━━━━━━━━━━━━━━
 🎰 شانس خود را امتحان کنید و جایزه بگیرید!
 
-1. 🎁 <b>باکس سکه</b>
-   • قیمت: 500 سکه
-   • جایزه: 100-2000 سکه
-   
-2. 🎁 <b>باکس ZP</b>
-   • قیمت: 1000 سکه
-   • جایزه: 50-500 ZP
-
-3. 💎 <b>باکس ویژه</b>
-   • قیمت: 5 جم
-   • جایزه: موشک‌های ویژه
-
-4. 👑 <b>باکس افسانه‌ای</b>
-   • قیمت: 10 جم
-   • جایزه: ترکیبی (شانس 10% جکپات)
-
-5. 🆓 <b>باکس رایگان</b>
-   • قیمت: رایگان
-   • جایزه: 10-100 (تصادفی)
-   • بازدید بعدی: 24 ساعت بعد
+{BOX_MENU_TEXT}
+
+🔁 بعد از باز کردن هر باکس پولی می‌توانید ×10 یا ×100 را یکجا باز کنید.
     """
     
-    await message.answer(box_text, reply_markup=keyboard)
+    await message.answer(box_text, reply_markup=BOX_KEYBOARD)
+
+@callbacks.route('box')
+async def process_box(callback: CallbackQuery, box_type: str):
+    await open_boxes(callback, box_type, 1)
 
-@dp.callback_query(F.data.startswith("box_"))
-async def process_box(callback: CallbackQuery):
-    box_type = callback.data.replace("box_", "")
+@callbacks.route('box_bulk')
+async def process_box_bulk(callback: CallbackQuery, box_type: str, count: int):
+    await open_boxes(callback, box_type, count)
+
+async def open_boxes(callback: CallbackQuery, box_type: str, count: int):
+    """باز کردن count باکس: رول همه جوایز با جدول loot و ثبت مجموع در یک تراکنش"""
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await callback.answer("❌ کاربر یافت نشد!")
         return
     
-    rewards = {
-        'coin': {'min': 100, 'max': 2000, 'cost_coin': 500, 'cost_gem': 0},
-        'zp': {'min': 50, 'max': 500, 'cost_coin': 1000, 'cost_gem': 0},
-        'special': {'min': 1, 'max': 3, 'cost_coin': 0, 'cost_gem': 5, 'type': 'missile'},
-        'legendary': {'min': 1000, 'max': 10000, 'cost_coin': 0, 'cost_gem': 10, 'type': 'mixed'},
-        'free': {'min': 10, 'max': 100, 'cost_coin': 0, 'cost_gem': 0, 'cooldown': 86400}  # 24 ساعت
-    }
-    
-    if box_type not in rewards:
-        await callback.answer("❌ باکس نامعتبر!")
-        return
-    
-    reward = rewards[box_type]
+    box = BOX_DATA[box_type]
+    cost_coin = box['cost_coin'] * count
+    cost_gem = box['cost_gem'] * count
     
     # بررسی موجودی برای باکس‌های پولی
-    if box_type != 'free':
-        if user['zone_coin'] < reward['cost_coin']:
-            await callback.answer("❌ سکه کافی ندارید!")
-            return
-        
-        if user['zone_gem'] < reward['cost_gem']:
-            await callback.answer("❌ جم کافی ندارید!")
-            return
+    if user['zone_coin'] < cost_coin:
+        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {cost_coin:,} ZC")
+        return
     
-    # کسر هزینه برای باکس‌های پولی
-    if reward['cost_coin'] > 0:
-        db.update_user_coins(user_id, -reward['cost_coin'])
-    if reward['cost_gem'] > 0:
-        db.update_user_gems(user_id, -reward['cost_gem'])
+    if user['zone_gem'] < cost_gem:
+        await callback.answer(f"❌ جم کافی ندارید! نیاز: {cost_gem:,} ZG")
+        return
     
     # تولید جایزه
-    prize_text = ""
-    prize_value = 0
+    loot = LOOT_TABLES[box_type].roll(count)
+    
+    # کسر شرطی هزینه و افزودن جایزه در یک تراکنش
+    user = await adb.spend_and_grant(
+        user_id,
+        coins=cost_coin,
+        gems=cost_gem,
+        grant={'coins': loot['coins'], 'zp': loot['zp'], 'missiles': loot['missiles']}
+    )
     
-    if box_type == 'free':
-        prize = random.randint(reward['min'], reward['max'])
-        prize_type = random.choice(['coin', 'zp'])
-        
-        if prize_type == 'coin':
-            db.update_user_coins(user_id, prize)
-            prize_text = f"{prize} سکه"
-            prize_value = prize
-        else:
-            db.update_user_zp(user_id, prize)
-            prize_text = f"{prize} ZP"
-            prize_value = prize
-    
-    elif box_type == 'special':
-        # جایزه موشک ویژه
-        special_missiles = ['شهاب (Meteor)', 'سیل (Tsunami)', 'توفان (Storm)']
-        missile = random.choice(special_missiles)
-        
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO user_missiles (user_id, missile_name, quantity)
-        VALUES (?, ?, 1)
-        ON CONFLICT(user_id, missile_name) 
-        DO UPDATE SET quantity = quantity + 1
-        ''', (user_id, missile))
-        conn.commit()
-        conn.close()
-        
-        prize_text = f"1 عدد {missile}"
-        prize_value = MISSILE_DATA[missile]['price']
-    
-    elif box_type == 'legendary':
-        # شانس 10% برای جایزه ویژه
-        if random.random() < 0.1:  # 10% شانس جکپات
-            prize = random.randint(5000, 20000)
-            db.update_user_coins(user_id, prize)
-            prize_text = f"🎉 جکپات! {prize} سکه"
-            prize_value = prize
-        else:
-            prize = random.randint(reward['min'], reward['max'])
-            db.update_user_coins(user_id, prize)
-            prize_text = f"{prize} سکه"
-            prize_value = prize
-    
-    else:  # باکس‌های معمولی
-        prize = random.randint(reward['min'], reward['max'])
-        if box_type == 'coin':
-            db.update_user_coins(user_id, prize)
-            prize_text = f"{prize} سکه"
-            prize_value = prize
-        else:  # zp
-            db.update_user_zp(user_id, prize)
-            prize_text = f"{prize} ZP"
-            prize_value = prize
-    
-    # نام باکس
-    box_names = {
-        'coin': 'باکس سکه',
-        'zp': 'باکس ZP',
-        'special': 'باکس ویژه',
-        'legendary': 'باکس افسانه‌ای',
-        'free': 'باکس رایگان'
-    }
+    if not user:
+        await callback.answer("❌ موجودی کافی ندارید!")
+        return
     
     # گزارش
     report_text = f"""
-🎉 <b>باکس باز شد!</b>
+🎉 <b>{'باکس باز شد!' if count == 1 else f'{count} باکس باز شد!'}</b>
 ━━━━━━━━━━━━━━
-🎁 نوع باکس: {box_names[box_type]}
-🎰 جایزه: {prize_text}
-💰 ارزش تقریبی: {prize_value} ZC
+🎁 نوع باکس: {box['name']}{f' ×{count}' if count > 1 else ''}
+🎰 جایزه: {loot_text(loot)}
+💰 ارزش تقریبی: {loot_value(loot):,} ZC
 ━━━━━━━━━━━━━━
-💰 سکه فعلی: {user['zone_coin'] - reward['cost_coin'] + (prize if box_type == 'coin' or box_type == 'legendary' else 0)}
-💎 جم فعلی: {user['zone_gem'] - reward['cost_gem']}
-⚡ ZP فعلی: {user['zone_point'] + (prize if box_type == 'zp' else 0)}
+💰 سکه فعلی: {user['zone_coin']}
+💎 جم فعلی: {user['zone_gem']}
+⚡ ZP فعلی: {user['zone_point']}
 ━━━━━━━━━━━━━━
-{'🎊 تبریک! شانس با شما یار بود!' if box_type == 'legendary' and random.random() < 0.1 else ''}
+{'🎊 تبریک! شانس با شما یار بود!' if loot['jackpots'] else ''}
     """
     
-    await callback.message.edit_text(report_text)
+    await callback.message.edit_text(report_text, reply_markup=BOX_RESULT_KEYBOARDS[box_type])
     await callback.answer("✅ باکس با موفقیت باز شد!")
 
 @dp.message(F.text == "⛏️ ماینر")
 async def cmd_miner(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
     # محاسبه ZP قابل دریافت
-    miner_zp = 0
-    if user['last_miner_claim']:
-        time_passed = int(time.time()) - user['last_miner_claim']
-        if time_passed > 0:
-            zp_per_hour = MINER_LEVELS[user['miner_level']]['zp_per_hour']
-            miner_zp = int((time_passed / 3600) * zp_per_hour)
+    time_passed = max(int(time.time()) - miner_since(user), 0)
+    miner_zp = miner_pending(user['miner_level'], miner_since(user), int(time.time()))
     
     # ایجاد کیبورد ماینر
     keyboard_buttons = []
     
     if miner_zp > 0:
-        keyboard_buttons.append([InlineKeyboardButton(text=f"📦 دریافت {miner_zp} ZP", callback_data="claim_miner")])
+        keyboard_buttons.append([InlineKeyboardButton(text=f"📦 دریافت {miner_zp} ZP", callback_data=cb_data('claim_miner'))])
     
     current_level = user['miner_level']
-    if current_level < 15:
-        upgrade_cost = MINER_LEVELS[current_level]['upgrade_cost']
-        next_zp = MINER_LEVELS.get(current_level + 1, {}).get('zp_per_hour', 'ماکس')
-        keyboard_buttons.append([InlineKeyboardButton(text=f"⬆️ ارتقا به لول {current_level + 1}", callback_data="upgrade_miner")])
+    if current_level in MINER_UPGRADE_ROWS:
+        keyboard_buttons.append(MINER_UPGRADE_ROWS[current_level])
     
-    keyboard_buttons.append([InlineKeyboardButton(text="📊 اطلاعات ماینر", callback_data="miner_info")])
-    keyboard_buttons.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")])
+    keyboard_buttons.append(MINER_INFO_ROW)
+    keyboard_buttons.append([BACK_BUTTON])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     
-    # زمان آخرین دریافت
-    last_claim_time = "هرگز"
-    if user['last_miner_claim']:
-        last_claim_time = datetime.fromtimestamp(user['last_miner_claim']).strftime('%H:%M')
+    # شروع دوره تولید فعلی (آخرین دریافت، یا ثبت‌نام/ارتقای ربات اگر هنوز دریافتی نبوده)
+    production_start = datetime.fromtimestamp(miner_since(user)).strftime('%m/%d %H:%M')
     
     # اطلاعات سطح بعدی
     next_level_info = ""
-    if current_level < 15:
+    if current_level < MINER_MAX_LEVEL:
         next_level = current_level + 1
         next_zp = MINER_LEVELS[next_level]['zp_per_hour']
         next_cost = MINER_LEVELS[current_level]['upgrade_cost']
@@ -1249,8 +2992,8 @@ async def cmd_miner(message: Message):
 💰 هزینه ارتقا فعلی: {MINER_LEVELS[current_level]['upgrade_cost']} ZC
 ━━━━━━━━━━━━━━
 📦 ZP قابل دریافت: {miner_zp}
-⏰ آخرین دریافت: {last_claim_time}
-⏳ زمان سپری شده: {time_passed // 3600 if user['last_miner_claim'] else 0} ساعت
+⏰ شروع تولید فعلی: {production_start}
+⏳ زمان سپری شده: {time_passed // 3600} ساعت
 ━━━━━━━━━━━━━━
 {next_level_info}
 ━━━━━━━━━━━━━━
@@ -1259,54 +3002,46 @@ async def cmd_miner(message: Message):
     
     await message.answer(miner_text, reply_markup=keyboard)
 
-@dp.callback_query(F.data == "claim_miner")
+@callbacks.route('claim_miner')
 async def process_claim_miner(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await callback.answer("❌ کاربر یافت نشد!")
         return
     
-    # محاسبه ZP قابل دریافت
-    miner_zp = 0
-    if user['last_miner_claim']:
-        time_passed = int(time.time()) - user['last_miner_claim']
-        if time_passed > 0:
-            zp_per_hour = MINER_LEVELS[user['miner_level']]['zp_per_hour']
-            miner_zp = int((time_passed / 3600) * zp_per_hour)
-    
-    if miner_zp <= 0:
+    # محاسبه و ثبت برداشت در یک UPDATE شرطی (کلیک دوباره چیزی برداشت نمی‌کند)
+    claim = await adb.claim_miner(user_id, miner_since(user), int(time.time()))
+    
+    if not claim:
         await callback.answer("❌ هنوز ZP جدیدی تولید نشده!")
         return
     
-    # دریافت ZP
-    db.update_user_zp(user_id, miner_zp)
-    
-    # آپدیت زمان آخرین دریافت
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET last_miner_claim = ? WHERE user_id = ?', 
-                  (int(time.time()), user_id))
-    conn.commit()
-    conn.close()
-    
     await callback.message.edit_text(f"""
 ✅ <b>دریافت موفق!</b>
 ━━━━━━━━━━━━━━
-⛏️ ZP دریافتی: {miner_zp}
-💰 ZP کل: {user['zone_point'] + miner_zp} ZP
+⛏️ ZP دریافتی: {claim['zp']}
+💰 ZP کل: {claim['zone_point']} ZP
 ⏰ زمان دریافت: {datetime.now().strftime('%H:%M')}
 ━━━━━━━━━━━━━━
 ⚡ ماینر دوباره شروع به کار کرد!
-📊 تولید فعلی: {MINER_LEVELS[user['miner_level']]['zp_per_hour']} ZP/ساعت
+📊 تولید فعلی: {MINER_LEVELS[claim['miner_level']]['zp_per_hour']} ZP/ساعت
     """)
-    await callback.answer(f"✅ {miner_zp} ZP دریافت شد!")
+    await callback.answer(f"✅ {claim['zp']} ZP دریافت شد!")
 
-@dp.callback_query(F.data == "upgrade_miner")
+@callbacks.route('upgrade_miner')
 async def process_upgrade_miner(callback: CallbackQuery):
+    await upgrade_miner_levels(callback, 1)
+
+@callbacks.route('upgrade_miner_max')
+async def process_upgrade_miner_max(callback: CallbackQuery):
+    await upgrade_miner_levels(callback, None)
+
+async def upgrade_miner_levels(callback: CallbackQuery, max_levels: Optional[int]):
+    """ارتقای ماینر تا max_levels لول (None = بدون محدودیت) (به اندازه موجودی) در یک تراکنش"""
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await callback.answer("❌ کاربر یافت نشد!")
@@ -1315,40 +3050,40 @@ async def process_upgrade_miner(callback: CallbackQuery):
     current_level = user['miner_level']
     
     # بررسی ماکس لول
-    if current_level >= 15:
+    if current_level >= MINER_MAX_LEVEL:
         await callback.answer("🎉 ماینر شما در ماکس لول است!")
         return
     
-    upgrade_cost = MINER_LEVELS[current_level]['upgrade_cost']
-    
     # بررسی موجودی
-    if user['zone_coin'] < upgrade_cost:
-        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} ZC")
+    levels, upgrade_cost = miner_upgrade_plan(user, max_levels)
+    if not levels:
+        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {MINER_LEVELS[current_level]['upgrade_cost']} ZC")
         return
     
-    # ارتقا
-    db.update_user_coins(user_id, -upgrade_cost)
+    # ارتقا (فقط اگر لول در این فاصله عوض نشده باشد)
+    user = await adb.spend_and_grant(
+        user_id, coins=upgrade_cost,
+        grant={'levels': {'miner_level': levels}}, expect={'miner_level': current_level}
+    )
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET miner_level = miner_level + 1 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    if not user:
+        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} ZC")
+        return
     
-    new_level = current_level + 1
+    new_level = user['miner_level']
     
     await callback.message.edit_text(f"""
 ⬆️ <b>ارتقا موفق!</b>
 ━━━━━━━━━━━━━━
-⛏️ سطح جدید: {new_level}
+⛏️ سطح جدید: {new_level}{f' (+{levels} لول)' if levels > 1 else ''}
 ⚡ تولید جدید: {MINER_LEVELS[new_level]['zp_per_hour']} ZP/ساعت
 💰 هزینه پرداختی: {upgrade_cost} ZC
 ━━━━━━━━━━━━━━
-💰 سکه باقی‌مانده: {user['zone_coin'] - upgrade_cost} ZC
+💰 سکه باقی‌مانده: {user['zone_coin']} ZC
 🎉 ماینر شما با قدرت بیشتر کار می‌کند!
 
 📊 <b>آینده:</b>
-• سطح بعدی: {new_level + 1 if new_level < 15 else 'ماکس'}
+• سطح بعدی: {new_level + 1 if new_level < MINER_MAX_LEVEL else 'ماکس'}
 • هزینه بعدی: {MINER_LEVELS.get(new_level, {}).get('upgrade_cost', 'ماکس')} ZC
     """)
     await callback.answer(f"✅ ماینر به سطح {new_level} ارتقا یافت!")
@@ -1356,142 +3091,99 @@ async def process_upgrade_miner(callback: CallbackQuery):
 @dp.message(F.text == "🏰 دفاع")
 async def cmd_defense(message: Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await message.answer("❌ ابتدا با /start ثبت نام کنید!")
         return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=f"🚀 دفاع موشکی", callback_data="upgrade_missile_def"),
-            InlineKeyboardButton(text=f"📡 جنگ الکترونیک", callback_data="upgrade_electronic_def")
-        ],
-        [
-            InlineKeyboardButton(text=f"✈️ ضد جنگنده", callback_data="upgrade_antifighter_def"),
-            InlineKeyboardButton(text="📊 اطلاعات دفاع", callback_data="defense_info")
-        ],
-        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="back_to_main")]
-    ])
-    
-    # محاسبه بانس هر سیستم
-    missile_bonus = user['defense_missile_level'] * 5
-    electronic_bonus = user['defense_electronic_level'] * 3
-    antifighter_bonus = user['defense_antifighter_level'] * 7
+    # بانس و هزینه ارتقای هر سیستم از DEFENSE_SYSTEMS
     total_bonus = user['total_defense_bonus'] * 100
+    systems_text = "\n\n".join(
+        f"""{system['icon']} <b>{system['name']}</b>
+   • لول: {user[DEFENSE_COLUMNS[defense_type]]}
+   • بانس: {user[DEFENSE_COLUMNS[defense_type]] * system['bonus']}%
+   • هزینه ارتقا: {(user[DEFENSE_COLUMNS[defense_type]] + 1) * system['cost']} ZC"""
+        for defense_type, system in DEFENSE_SYSTEMS.items()
+    )
     
     defense_text = f"""
 🏰 <b>سیستم دفاع</b>
 ━━━━━━━━━━━━━━
 🛡️ بانس دفاع کلی: {total_bonus:.1f}%
 ━━━━━━━━━━━━━━
-🚀 <b>دفاع موشکی</b>
-   • لول: {user['defense_missile_level']}
-   • بانس: {missile_bonus}%
-   • هزینه ارتقا: {(user['defense_missile_level'] + 1) * 1000} ZC
-
-📡 <b>جنگ الکترونیک</b>
-   • لول: {user['defense_electronic_level']}
-   • بانس: {electronic_bonus}%
-   • هزینه ارتقا: {(user['defense_electronic_level'] + 1) * 800} ZC
-
-✈️ <b>ضد جنگنده</b>
-   • لول: {user['defense_antifighter_level']}
-   • بانس: {antifighter_bonus}%
-   • هزینه ارتقا: {(user['defense_antifighter_level'] + 1) * 1200} ZC
+{systems_text}
 ━━━━━━━━━━━━━━
 💰 سکه شما: {user['zone_coin']} ZC
 ━━━━━━━━━━━━━━
-⚠️ <i>هر لول دفاع درصد خاصی از خسارت را کاهش می‌دهد.</i>
+⚠️ <i>هر لول دفاع درصد خاصی از خسارت را کاهش می‌دهد (حداکثر {DEFENSE_BONUS_CAP}%).</i>
+⏫ <i>دکمه‌های ⏫ تا جایی که سکه و سقف بانس اجازه دهد ارتقا می‌دهند.</i>
     """
     
-    await message.answer(defense_text, reply_markup=keyboard)
+    await message.answer(defense_text, reply_markup=DEFENSE_KEYBOARD)
+
+@callbacks.route('upgrade_defense')
+async def process_upgrade_defense(callback: CallbackQuery, defense_type: str):
+    await upgrade_defense_levels(callback, defense_type, 1)
+
+@callbacks.route('upgrade_defense_max')
+async def process_upgrade_defense_max(callback: CallbackQuery, defense_type: str):
+    await upgrade_defense_levels(callback, defense_type, None)
 
-@dp.callback_query(F.data.startswith("upgrade_"))
-async def process_upgrade_defense(callback: CallbackQuery):
-    defense_type = callback.data.replace("upgrade_", "").replace("_def", "")
+async def upgrade_defense_levels(callback: CallbackQuery, defense_type: str, max_levels: Optional[int]):
+    """ارتقای یک سیستم دفاع تا max_levels لول (None = بدون محدودیت) (به اندازه موجودی و تا سقف بانس) در یک تراکنش"""
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await callback.answer("❌ کاربر یافت نشد!")
         return
     
-    # محاسبه هزینه ارتقا
-    current_level = 0
-    cost_multiplier = 0
-    defense_name = ""
-    
-    if defense_type == 'missile':
-        current_level = user['defense_missile_level']
-        cost_multiplier = 1000
-        defense_name = "دفاع موشکی"
-    elif defense_type == 'electronic':
-        current_level = user['defense_electronic_level']
-        cost_multiplier = 800
-        defense_name = "جنگ الکترونیک"
-    elif defense_type == 'antifighter':
-        current_level = user['defense_antifighter_level']
-        cost_multiplier = 1200
-        defense_name = "ضد جنگنده"
-    else:
-        await callback.answer("❌ سیستم دفاع نامعتبر!")
-        return
+    system = DEFENSE_SYSTEMS[defense_type]
+    column = DEFENSE_COLUMNS[defense_type]
+    current_level = user[column]
     
-    upgrade_cost = (current_level + 1) * cost_multiplier
+    # بررسی سقف بانس
+    if user['total_defense_bonus'] * 100 >= DEFENSE_BONUS_CAP:
+        await callback.answer(f"🛡️ بانس دفاع شما در حداکثر ({DEFENSE_BONUS_CAP}%) است!")
+        return
     
     # بررسی موجودی
-    if user['zone_coin'] < upgrade_cost:
-        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} ZC")
+    levels, upgrade_cost = defense_upgrade_plan(user, defense_type, max_levels)
+    if not levels:
+        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {(current_level + 1) * system['cost']} ZC")
         return
     
-    # ارتقا
-    db.update_user_coins(user_id, -upgrade_cost)
-    
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    if defense_type == 'missile':
-        cursor.execute('UPDATE users SET defense_missile_level = defense_missile_level + 1 WHERE user_id = ?', (user_id,))
-    elif defense_type == 'electronic':
-        cursor.execute('UPDATE users SET defense_electronic_level = defense_electronic_level + 1 WHERE user_id = ?', (user_id,))
-    elif defense_type == 'antifighter':
-        cursor.execute('UPDATE users SET defense_antifighter_level = defense_antifighter_level + 1 WHERE user_id = ?', (user_id,))
-    
-    # محاسبه بانس جدید
-    cursor.execute('''
-    UPDATE users SET total_defense_bonus = 
-        (defense_missile_level * 0.05) + 
-        (defense_electronic_level * 0.03) + 
-        (defense_antifighter_level * 0.07)
-    WHERE user_id = ?
-    ''', (user_id,))
+    # ارتقا و محاسبه بانس جدید در یک تراکنش
+    user = await adb.spend_and_grant(
+        user_id, coins=upgrade_cost, grant={'levels': {column: levels}}, expect={column: current_level}
+    )
     
-    conn.commit()
-    conn.close()
+    if not user:
+        await callback.answer(f"❌ سکه کافی ندارید! نیاز: {upgrade_cost} ZC")
+        return
     
-    # دریافت اطلاعات جدید
-    updated_user = db.get_user(user_id)
-    new_total_bonus = updated_user['total_defense_bonus'] * 100
+    new_total_bonus = user['total_defense_bonus'] * 100
     
     await callback.message.edit_text(f"""
 🛡️ <b>ارتقا موفق!</b>
 ━━━━━━━━━━━━━━
-🏰 سیستم: {defense_name}
-📈 لول جدید: {current_level + 1}
+🏰 سیستم: {system['name']}
+📈 لول جدید: {user[column]}{f' (+{levels} لول)' if levels > 1 else ''}
 💰 هزینه: {upgrade_cost} ZC
 ━━━━━━━━━━━━━━
 🛡️ بانس دفاع کلی: {new_total_bonus:.1f}%
-💰 سکه باقی‌مانده: {user['zone_coin'] - upgrade_cost} ZC
+💰 سکه باقی‌مانده: {user['zone_coin']} ZC
 ━━━━━━━━━━━━━━
 ✅ سیستم دفاع شما تقویت شد!
-⚠️ حداکثر بانس دفاع: 50%
+⚠️ حداکثر بانس دفاع: {DEFENSE_BONUS_CAP}%
     """)
-    await callback.answer(f"✅ {defense_name} ارتقا یافت!")
+    await callback.answer(f"✅ {system['name']} ارتقا یافت!")
 
 @dp.message(F.text == "📊 رنکینگ")
 async def cmd_ranking(message: Message):
-    top_users = db.get_top_users(15)
+    top_users = await adb.get_top_users(15)
+    my_rank, total_ranked = await adb.get_user_rank(message.from_user.id)
     
     if not top_users:
         await message.answer("📭 هنوز کاربری در رنکینگ وجود ندارد!")
@@ -1520,6 +3212,7 @@ async def cmd_ranking(message: Message):
 • تعداد کاربران در رنکینگ: {len(top_users)}
 • بیشترین سکه: {top_users[0]['zone_coin']:,} ZC
 • بالاترین لول: لول {max(u['level'] for u in top_users)}
+📍 رتبه شما: {f"#{my_rank:,} از {total_ranked:,}" if my_rank else "ثبت نشده"}
     """
     
     await message.answer(ranking_text)
@@ -1592,6 +3285,188 @@ async def cmd_help(message: Message):
     
     await message.answer(help_text)
 
+# === موتور پیام همگانی ===
+class TokenBucket:
+    """محدودکننده نرخ با رزرو توکن (بدون قفل، مخصوص event loop)"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """توقف کل ارسال‌ها (برای RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        delay = max(-self.tokens / self.rate, self.paused_until - now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class ChatRateLimiter:
+    """حداقل فاصله بین دو پیام به یک چت (محدودیت هر چت تلگرام)"""
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.next_allowed = {}
+
+    async def acquire(self, chat_id: int):
+        now = time.monotonic()
+        allowed = self.next_allowed.get(chat_id, 0.0)
+        self.next_allowed[chat_id] = max(now, allowed) + self.interval
+        if allowed > now:
+            await asyncio.sleep(allowed - now)
+        if len(self.next_allowed) > 10000:
+            self.next_allowed = {cid: t for cid, t in self.next_allowed.items() if t > now}
+
+
+class BroadcastEngine:
+    """
+    ارسال همگانی همزمان با محدودیت نرخ کلی و هر چت، رعایت RetryAfter،
+    خواندن گیرنده‌ها از دیتابیس به صورت تکه‌ای و ذخیره پیشرفت بعد از هر تکه.
+    """
+
+    MAX_ATTEMPTS = 3
+    REPORT_INTERVAL = 3.0
+
+    def __init__(self, bot: Bot, adb: AsyncDatabase, rate: float = 25,
+                 concurrency: int = 20, chunk_size: int = 200):
+        self.bot = bot
+        self.adb = adb
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = ChatRateLimiter()
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.tasks = {}
+
+    async def start(self, admin_id: int, text: str):
+        job = await self.adb.create_broadcast(admin_id, text)
+        progress = await self.bot.send_message(admin_id, self.render(job))
+        job['progress_message_id'] = progress.message_id
+        await self.adb.save_broadcast(job)
+        self.spawn(job)
+        return job
+
+    async def resume(self):
+        """ادامه پیام‌های نیمه‌کاره بعد از ری‌استارت"""
+        for job in await self.adb.get_running_broadcasts():
+            if job['id'] not in self.tasks:
+                logger.info(f"Resuming broadcast #{job['id']} after user {job['last_user_id']}")
+                self.spawn(job)
+
+    async def stop(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
+
+    def spawn(self, job: dict):
+        task = asyncio.create_task(self.run(job))
+        self.tasks[job['id']] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job['id'], None))
+
+    async def run(self, job: dict):
+        text = f"📢 <b>پیام همگانی از مدیریت</b>\n━━━━━━━━━━━━━━\n{job['text']}"
+        last_report = time.monotonic()
+        try:
+            while True:
+                user_ids = await self.adb.get_user_ids_after(job['last_user_id'], self.chunk_size)
+                if not user_ids:
+                    break
+                
+                # ارسال همزمان یک تکه با concurrency کارگر
+                pending = iter(user_ids)
+                
+                async def worker():
+                    for user_id in pending:
+                        await self.deliver(job, user_id, text)
+                
+                await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(user_ids)))))
+                
+                # نقطه بازیابی بعد از هر تکه
+                job['last_user_id'] = user_ids[-1]
+                await self.adb.save_broadcast(job)
+                
+                if time.monotonic() - last_report >= self.REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    await self.report(job)
+            
+            job['status'] = 'done'
+            await self.adb.save_broadcast(job)
+            await self.report(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast #{job['id']} failed: {e}")
+            job['status'] = 'failed'
+            await self.adb.save_broadcast(job)
+            await self.report(job)
+
+    async def deliver(self, job: dict, user_id: int, text: str):
+        for _ in range(self.MAX_ATTEMPTS):
+            await self.bucket.acquire()
+            await self.chat_limiter.acquire(user_id)
+            try:
+                await self.bot.send_message(user_id, text)
+                job['sent'] += 1
+                return
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                job['blocked'] += 1
+                return
+            except TelegramBadRequest:
+                job['failed'] += 1
+                return
+            except Exception as e:
+                logger.warning(f"Broadcast #{job['id']} send to {user_id} failed: {e}")
+                job['failed'] += 1
+                return
+        job['failed'] += 1
+
+    def render(self, job: dict):
+        done = job['sent'] + job['failed'] + job['blocked']
+        percent = done * 100 / job['total'] if job['total'] else 100
+        status = {
+            'running': '⏳ در حال ارسال',
+            'done': '✅ پایان ارسال',
+            'failed': '❌ متوقف شد'
+        }[job['status']]
+        return f"""
+📢 <b>پیام همگانی #{job['id']}</b>
+━━━━━━━━━━━━━━
+{status} ({percent:.1f}%)
+📤 ارسال شده به: {job['sent']} کاربر
+🚫 بلاک کرده: {job['blocked']} کاربر
+❌ ناموفق: {job['failed']} کاربر
+👥 کل: {job['total']} کاربر
+📝 متن ارسالی:
+{job['text'][:100]}...
+    """
+
+    async def report(self, job: dict):
+        """به‌روزرسانی پیام پیشرفت ادمین"""
+        try:
+            if job['progress_message_id']:
+                await self.bot.edit_message_text(
+                    self.render(job), chat_id=job['admin_id'], message_id=job['progress_message_id']
+                )
+            else:
+                await self.bot.send_message(job['admin_id'], self.render(job))
+        except Exception as e:
+            logger.warning(f"Broadcast #{job['id']} progress report failed: {e}")
+
+broadcaster = BroadcastEngine(
+    bot, adb, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY, chunk_size=BROADCAST_CHUNK
+)
+
 # === دستورات ادمین ===
 @dp.message(F.text == "👑 پنل ادمین")
 async def cmd_admin_panel(message: Message):
@@ -1602,7 +3477,7 @@ async def cmd_admin_panel(message: Message):
         return
     
     # بررسی در دیتابیس
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user or not user['is_admin']:
         await message.answer("❌ دسترسی ممنوع! شما ادمین نیستید.")
         return
@@ -1625,7 +3500,7 @@ async def cmd_admin_panel(message: Message):
 ⚠️ دسترسی فقط برای ادمین‌ها
     """
     
-    await message.answer(admin_text, reply_markup=create_admin_keyboard())
+    await message.answer(admin_text, reply_markup=ADMIN_KEYBOARD)
 
 @dp.message(F.text == "📊 آمار کامل")
 async def cmd_admin_stats(message: Message):
@@ -1635,43 +3510,18 @@ async def cmd_admin_stats(message: Message):
         await message.answer("❌ دسترسی ممنوع!")
         return
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    # آمار کلی
-    cursor.execute('SELECT COUNT(*) as total_users FROM users')
-    total_users = cursor.fetchone()['total_users']
-    
-    cursor.execute('SELECT COUNT(*) as total_attacks FROM attacks')
-    total_attacks = cursor.fetchone()['total_attacks']
-    
-    cursor.execute('SELECT SUM(zone_coin) as total_coins FROM users')
-    total_coins = cursor.fetchone()['total_coins'] or 0
-    
-    cursor.execute('SELECT SUM(zone_gem) as total_gems FROM users')
-    total_gems = cursor.fetchone()['total_gems'] or 0
-    
-    cursor.execute('SELECT SUM(zone_point) as total_zp FROM users')
-    total_zp = cursor.fetchone()['total_zp'] or 0
-    
-    cursor.execute('SELECT AVG(level) as avg_level FROM users')
-    avg_level = cursor.fetchone()['avg_level'] or 0
-    
-    # آخرین کاربران
-    cursor.execute('''
-    SELECT user_id, username, full_name, created_at 
-    FROM users 
-    ORDER BY created_at DESC 
-    LIMIT 5
-    ''')
-    recent_users = cursor.fetchall()
-    
-    # فعالیت امروز
-    today = int(time.time()) - 86400
-    cursor.execute('SELECT COUNT(*) as today_users FROM users WHERE created_at > ?', (today,))
-    today_users = cursor.fetchone()['today_users']
-    
-    conn.close()
+    stats = await adb.get_admin_stats()
+    total_users = stats['total_users']
+    log_stats = attack_log.stats()
+    total_attacks = stats['total_attacks'] + log_stats['pending']
+    total_coins = stats['total_coins']
+    total_gems = stats['total_gems']
+    total_zp = stats['total_zp']
+    avg_level = stats['avg_level']
+    recent_users = stats['recent_users']
+    today_users = stats['today_users']
+    write_stats = writer.stats()
+    cache_stats = db.cache.stats()
     
     stats_text = f"""
 📊 <b>آمار کامل ربات</b>
@@ -1685,6 +3535,12 @@ async def cmd_admin_stats(message: Message):
 💎 کل جم‌ها: {total_gems:,} ZG  
 ⚡ کل ZP: {total_zp:,} ZP
 ━━━━━━━━━━━━━━
+📝 نوشتن گروهی: {write_stats['batches']} دسته / {write_stats['operations']} عملیات
+📦 اندازه دسته: میانگین {write_stats['avg_batch_size']:.1f} | حداکثر {write_stats['max_batch_size']}
+⏱️ تأخیر flush: میانگین {write_stats['avg_flush_ms']:.2f}ms | آخرین {write_stats['last_flush_ms']:.2f}ms
+⚔️ لاگ حمله‌ها: {log_stats['written']} ذخیره شده | {log_stats['pending']} در صف | {log_stats['dropped']} حذف شده
+🗂️ کش کاربران: {cache_stats['users']} ردیف | نرخ hit {cache_stats['hit_rate']*100:.1f}% ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})
+━━━━━━━━━━━━━━
 📅 <b>آخرین کاربران:</b>
     """
     
@@ -1710,32 +3566,13 @@ async def cmd_broadcast(message: Message, state: FSMContext):
 async def process_broadcast(message: Message, state: FSMContext):
     broadcast_text = message.text
     
-    users = db.get_all_users()
-    
-    success = 0
-    failed = 0
-    
-    for user in users:
-        try:
-            await bot.send_message(
-                user['user_id'], 
-                f"📢 <b>پیام همگانی از مدیریت</b>\n━━━━━━━━━━━━━━\n{broadcast_text}"
-            )
-            success += 1
-            await asyncio.sleep(0.05)  # جلوگیری از محدودیت
-        except:
-            failed += 1
-    
-    await message.answer(f"""
-✅ <b>ارسال پیام همگانی</b>
-━━━━━━━━━━━━━━
-📤 ارسال شده به: {success} کاربر
-❌ ناموفق: {failed} کاربر
-📝 متن ارسالی:
-{broadcast_text[:100]}...
-    """)
+    if not broadcast_text:
+        await message.answer("❌ لطفا پیام متنی ارسال کنید!")
+        return
     
+    # ارسال در پس‌زمینه؛ پیشرفت در پیام جداگانه به‌روز می‌شود
     await state.clear()
+    await broadcaster.start(message.from_user.id, broadcast_text)
 
 @dp.message(F.text == "🎁 هدیه همگانی")
 async def cmd_global_gift(message: Message):
@@ -1745,59 +3582,44 @@ async def cmd_global_gift(message: Message):
         await message.answer("❌ دسترسی ممنوع!")
         return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💰 1000 سکه به همه", callback_data="gift_all_coins_1000")],
-        [InlineKeyboardButton(text="💎 10 جم به همه", callback_data="gift_all_gems_10")],
-        [InlineKeyboardButton(text="⚡ 500 ZP به همه", callback_data="gift_all_zp_500")],
-        [InlineKeyboardButton(text="🎁 همه موارد بالا", callback_data="gift_all_everything")],
-        [InlineKeyboardButton(text="💣 5 موشک شبح به همه", callback_data="gift_all_missiles")]
-    ])
+    await message.answer("🎁 انتخاب هدیه همگانی:\n🎯 گیرندگان: همه کاربران", reply_markup=GIFT_KEYBOARDS['all'])
+
+@callbacks.route('gift_filter')
+async def process_global_gift_filter(callback: CallbackQuery, gift_filter: str):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ دسترسی ممنوع!")
+        return
     
-    await message.answer("🎁 انتخاب هدیه همگانی:", reply_markup=keyboard)
-
-@dp.callback_query(F.data.startswith("gift_all_"))
-async def process_global_gift(callback: CallbackQuery):
-    gift_type = callback.data.replace("gift_all_", "")
-    
-    users = db.get_all_users()
-    
-    if gift_type == 'coins_1000':
-        for user in users:
-            db.update_user_coins(user['user_id'], 1000)
-        gift_text = "1000 سکه"
-    elif gift_type == 'gems_10':
-        for user in users:
-            db.update_user_gems(user['user_id'], 10)
-        gift_text = "10 جم"
-    elif gift_type == 'zp_500':
-        for user in users:
-            db.update_user_zp(user['user_id'], 500)
-        gift_text = "500 ZP"
-    elif gift_type == 'everything':
-        for user in users:
-            db.update_user_coins(user['user_id'], 1000)
-            db.update_user_gems(user['user_id'], 10)
-            db.update_user_zp(user['user_id'], 500)
-        gift_text = "1000 سکه + 10 جم + 500 ZP"
-    elif gift_type == 'missiles':
-        for user in users:
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-            INSERT INTO user_missiles (user_id, missile_name, quantity)
-            VALUES (?, ?, 5)
-            ON CONFLICT(user_id, missile_name) 
-            DO UPDATE SET quantity = quantity + 5
-            ''', (user['user_id'], 'شبح (Ghost)'))
-            conn.commit()
-            conn.close()
-        gift_text = "5 موشک شبح"
+    await callback.message.edit_text(
+        f"🎁 انتخاب هدیه همگانی:\n🎯 گیرندگان: {GIFT_FILTERS[gift_filter][0]}",
+        reply_markup=GIFT_KEYBOARDS[gift_filter]
+    )
+    await callback.answer()
+
+@callbacks.route('gift_all')
+async def process_global_gift(callback: CallbackQuery, gift_type: str, gift_filter: str):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ دسترسی ممنوع!")
+        return
+    
+    gift = GLOBAL_GIFTS[gift_type]
+    filter_label, min_level, active_days = GIFT_FILTERS[gift_filter]
+    
+    users_count = await adb.gift_all(
+        coins=gift.get('coins', 0),
+        gems=gift.get('gems', 0),
+        zp=gift.get('zp', 0),
+        missiles=gift.get('missiles'),
+        min_level=min_level,
+        active_days=active_days
+    )
     
     await callback.message.edit_text(f"""
 🎉 <b>هدیه همگانی ارسال شد!</b>
 ━━━━━━━━━━━━━━
-🎁 هدیه: {gift_text}
-👥 تعداد کاربران: {len(users)}
+🎁 هدیه: {gift['text']}
+🎯 گیرندگان: {filter_label}
+👥 تعداد کاربران: {users_count}
 ⏰ زمان: {datetime.now().strftime('%H:%M')}
     """)
     await callback.answer("✅ هدیه ارسال شد!")
@@ -1857,31 +3679,27 @@ async def process_gift_amount(message: Message, state: FSMContext):
         target_id = int(parts[0])
         amount = int(parts[1])
         
-        target_user = db.get_user(target_id)
+        target_user = await adb.get_user(target_id)
         if not target_user:
             await message.answer("❌ کاربر یافت نشد!")
             return
         
         # تشخیص نوع هدیه از متن قبلی
         if "سکه" in message.reply_to_message.text:
-            db.update_user_coins(target_id, amount)
+            await writer.add(target_id, coins=amount)
             gift_type = "سکه"
             new_amount = target_user['zone_coin'] + amount
         elif "جم" in message.reply_to_message.text:
-            db.update_user_gems(target_id, amount)
+            await writer.add(target_id, gems=amount)
             gift_type = "جم"
             new_amount = target_user['zone_gem'] + amount
         elif "ZP" in message.reply_to_message.text:
-            db.update_user_zp(target_id, amount)
+            await writer.add(target_id, zp=amount)
             gift_type = "ZP"
             new_amount = target_user['zone_point'] + amount
         elif "لول" in message.reply_to_message.text:
             # تغییر لول
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('UPDATE users SET level = ? WHERE user_id = ?', (amount, target_id))
-            conn.commit()
-            conn.close()
+            await adb.set_user_level(target_id, amount)
             gift_type = "لول"
             new_amount = amount
         else:
@@ -1908,17 +3726,17 @@ async def process_gift_amount(message: Message, state: FSMContext):
 
 @dp.message(F.text == "🔙 بازگشت")
 async def cmd_back_to_main(message: Message):
-    await message.answer("🔙 بازگشت به منوی اصلی", reply_markup=create_main_keyboard())
+    await message.answer("🔙 بازگشت به منوی اصلی", reply_markup=MAIN_KEYBOARD)
 
-@dp.callback_query(F.data == "back_to_main")
+@callbacks.route('back_to_main')
 async def callback_back_to_main(callback: CallbackQuery):
     await callback.message.edit_text("🔙 بازگشت به منوی اصلی")
-    await callback.message.answer("منوی اصلی:", reply_markup=create_main_keyboard())
+    await callback.message.answer("منوی اصلی:", reply_markup=MAIN_KEYBOARD)
 
-@dp.callback_query(F.data == "miner_info")
+@callbacks.route('miner_info')
 async def cmd_miner_info(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     miner_info = f"""
 ⛏️ <b>اطلاعات ماینر</b>
@@ -1941,29 +3759,30 @@ async def cmd_miner_info(callback: CallbackQuery):
     await callback.message.edit_text(miner_info)
     await callback.answer()
 
-@dp.callback_query(F.data == "defense_info")
+@callbacks.route('defense_info')
 async def cmd_defense_info(callback: CallbackQuery):
-    defense_info = """
+    missile, electronic, antifighter = (DEFENSE_SYSTEMS[name]['bonus'] for name in ('missile', 'electronic', 'antifighter'))
+    defense_info = f"""
 🏰 <b>اطلاعات سیستم دفاع</b>
 ━━━━━━━━━━━━━━
 🛡️ <b>دفاع موشکی:</b>
-• کاهش خسارت: 5% در هر سطح
-• حداکثر: 25% (سطح 5)
+• کاهش خسارت: {missile}% در هر سطح
+• حداکثر: {missile * 5}% (سطح 5)
 • بهترین در برابر: موشک‌های معمولی
 
 📡 <b>جنگ الکترونیک:</b>
-• کاهش خسارت: 3% در هر سطح
-• حداکثر: 15% (سطح 5)
+• کاهش خسارت: {electronic}% در هر سطح
+• حداکثر: {electronic * 5}% (سطح 5)
 • بهترین در برابر: موشک‌های هدایت‌شونده
 
 ✈️ <b>ضد جنگنده:</b>
-• کاهش خسارت: 7% در هر سطح
-• حداکثر: 35% (سطح 5)
+• کاهش خسارت: {antifighter}% در هر سطح
+• حداکثر: {antifighter * 5}% (سطح 5)
 • بهترین در برابر: حملات هوایی
 
 ━━━━━━━━━━━━━━
 ⚠️ <b>نکات مهم:</b>
-• حداکثر کاهش خسارت کلی: 50%
+• حداکثر کاهش خسارت کلی: {DEFENSE_BONUS_CAP}%
 • هر سیستم دفاعی در برابر نوع خاصی مؤثر است
 • ترکیب سیستم‌های دفاعی بهترین نتیجه را می‌دهد
 • ارتقای دفاع هزینه‌بر است اما ارزش دارد
@@ -1972,12 +3791,12 @@ async def cmd_defense_info(callback: CallbackQuery):
     await callback.message.edit_text(defense_info)
     await callback.answer()
 
-@dp.callback_query(F.data == "box_inventory")
+@callbacks.route('box_inventory')
 async def cmd_box_inventory(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
-    missiles = db.get_user_missiles(user_id)
+    missiles = await adb.get_user_missiles(user_id)
     
     inventory_text = f"""
 📦 <b>موجودی شما</b>
@@ -2004,6 +3823,40 @@ async def cmd_box_inventory(callback: CallbackQuery):
     await callback.message.edit_text(inventory_text)
     await callback.answer()
 
+# === HTTP: متریک و سلامت ===
+async def metrics_endpoint(request: web.Request):
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+async def health_endpoint(request: web.Request):
+    """liveness: پروسه زنده است و به درخواست پاسخ می‌دهد"""
+    return web.json_response({'status': 'ok'})
+
+async def ready_endpoint(request: web.Request):
+    """readiness: startup انجام شده و دیتابیس پاسخ می‌دهد"""
+    checks = {'writer': writer.task is not None and not writer.task.done()}
+    try:
+        checks['database'] = await asyncio.wait_for(adb.ping(), 2)
+    except Exception as e:
+        logger.error(f"Readiness check failed: {e}")
+        checks['database'] = False
+    return web.json_response(checks, status=200 if all(checks.values()) else 503)
+
+def setup_http_routes(app: web.Application):
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_get('/health', health_endpoint)
+    app.router.add_get('/ready', ready_endpoint)
+
+async def start_http_server(app: web.Application):
+    """اجرای app روی PORT؛ runner برای cleanup برگردانده می‌شود"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host='0.0.0.0', port=PORT)
+    await site.start()
+    return runner
+
 # === Keep Alive برای Railway ===
 async def keep_alive():
     """ارسال درخواست Keep-Alive"""
@@ -2015,10 +3868,65 @@ async def keep_alive():
         except Exception as e:
             logger.error(f"Keep-Alive error: {e}")
 
+@dp.startup()
+async def on_startup():
+    writer.start()
+    attack_log.start()
+    await broadcaster.resume()
+
+@dp.shutdown()
+async def on_shutdown():
+    await broadcaster.stop()
+    await writer.stop()
+    await attack_log.stop()
+
+async def run_webhook():
+    """دریافت آپدیت‌ها با webhook روی PORT"""
+    app = web.Application()
+    
+    # پاسخ فوری به تلگرام و پردازش آپدیت در پس‌زمینه (بررسی secret توسط handler)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    setup_http_routes(app)
+    
+    runner = await start_http_server(app)
+    logger.info(f"🌐 Webhook server listening on port {PORT}")
+    
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    
+    # انتظار تا SIGTERM/SIGINT
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     """تابع اصلی"""
     logger.info("🚀 Starting Warzone Bot...")
     
+    if BOT_MODE == 'webhook':
+        # در حالت webhook خود تلگرام سرور را بیدار نگه می‌دارد
+        try:
+            await run_webhook()
+        finally:
+            adb.close()
+        logger.info("🛑 Webhook server stopped")
+        return
+    
     # Keep-Alive دوره‌ای
     async def keep_alive_task():
         while True:
@@ -2028,10 +3936,21 @@ async def main():
     # شروع Keep-Alive
     asyncio.create_task(keep_alive_task())
     
+    # سرور HTTP فقط برای /metrics و /health و /ready
+    app = web.Application()
+    setup_http_routes(app)
+    runner = await start_http_server(app)
+    logger.info(f"📈 Metrics server listening on port {PORT}")
+    
     logger.info("🤖 Bot is starting to poll...")
     
     # راه‌اندازی ربات
-    await dp.start_polling(bot)
+    try:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+        adb.close()
     
     logger.info("🛑 Bot polling stopped")
 
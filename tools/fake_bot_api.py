@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+سرور جایگزین Bot API تلگرام برای بنچمارک و تست یکپارچه (کاملاً آفلاین).
+
+متدها: getMe, sendMessage, editMessageText, answerCallbackQuery, getUpdates,
+setWebhook, deleteWebhook
+شبیه‌سازی: تأخیر پاسخ، محدودیت نرخ با 429 و retry_after، کاربران بلاک‌کرده با 403
+
+اجرا:
+    python tools/fake_bot_api.py --port 8081 --latency-ms 40 --rate-limit 30 --blocked-ratio 0.05
+    BOT_API_URL=http://127.0.0.1:8081 python main.py
+
+کنترل (مخصوص تست):
+    POST /_control/updates   یک Update یا لیستی از Updateها (JSON) برای getUpdates/webhook
+    GET  /_control/stats     شمارنده‌ها
+    POST /_control/reset     صفر کردن شمارنده‌ها و صف آپدیت‌ها
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+
+class TokenBucket:
+    """محدودیت نرخ سمت سرور (مثل محدودیت کلی ~30 پیام در ثانیه تلگرام)"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self):
+        """None در صورت مجاز بودن، وگرنه ثانیه‌های انتظار"""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        return (1 - self.tokens) / self.rate
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, rate_limit: float = 0,
+                 flood_ratio: float = 0, retry_after: int = 1, blocked=(), blocked_ratio: float = 0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.flood_ratio = flood_ratio
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        self.blocked_ratio = blocked_ratio
+        self.bot_id = 1
+        self.handlers = {
+            'getMe': self.get_me,
+            'sendMessage': self.send_message,
+            'editMessageText': self.edit_message_text,
+            'answerCallbackQuery': self.answer_callback_query,
+            'getUpdates': self.get_updates,
+            'setWebhook': self.set_webhook,
+            'deleteWebhook': self.delete_webhook
+        }
+        self.reset()
+
+    def reset(self):
+        self.stats = Counter()
+        self.message_id = 0
+        self.update_id = 0
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.webhook = None
+
+    # === ابزارهای پاسخ ===
+    @staticmethod
+    def ok(result):
+        return web.json_response({'ok': True, 'result': result})
+
+    @staticmethod
+    def error(status: int, description: str, **parameters):
+        body = {'ok': False, 'error_code': status, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return web.json_response(body, status=status)
+
+    def is_blocked(self, chat_id: int):
+        if chat_id in self.blocked:
+            return True
+        # انتخاب قطعی بر اساس chat_id تا نتیجه در اجراهای مختلف یکسان باشد
+        return self.blocked_ratio > 0 and (chat_id * 2654435761 % 2 ** 32) / 2 ** 32 < self.blocked_ratio
+
+    def limit(self):
+        """پاسخ 429 در صورت عبور از محدودیت نرخ"""
+        wait = self.bucket.take() if self.bucket else None
+        if wait is None and self.flood_ratio and random.random() < self.flood_ratio:
+            wait = self.retry_after
+        if wait is None:
+            return None
+        retry_after = max(self.retry_after, int(wait + 0.999))
+        self.stats['429'] += 1
+        return self.error(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+
+    def make_message(self, chat_id: int, text: str, message_id: int = None):
+        if message_id is None:
+            self.message_id += 1
+            message_id = self.message_id
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'FakeBot'},
+            'text': text
+        }
+
+    # === مسیر اصلی ===
+    async def dispatch(self, request: web.Request):
+        token, method = request.match_info['token'], request.match_info['method']
+        if token.split(':')[0].isdigit():
+            self.bot_id = int(token.split(':')[0])
+        params = dict(await request.post())
+        if not params and request.can_read_body:
+            params = await request.json()
+        self.stats[method] += 1
+
+        handler = self.handlers.get(method)
+        if handler is None:
+            return self.error(404, 'Not Found: method not found')
+        if method != 'getUpdates' and (self.latency or self.jitter):
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        return await handler(params)
+
+    async def get_me(self, params):
+        return self.ok({'id': self.bot_id, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'})
+
+    async def send_message(self, params):
+        chat_id = int(params['chat_id'])
+        if self.is_blocked(chat_id):
+            self.stats['403'] += 1
+            return self.error(403, 'Forbidden: bot was blocked by the user')
+        limited = self.limit()
+        if limited is not None:
+            return limited
+        self.stats['messages_sent'] += 1
+        return self.ok(self.make_message(chat_id, params.get('text', '')))
+
+    async def edit_message_text(self, params):
+        limited = self.limit()
+        if limited is not None:
+            return limited
+        chat_id = int(params.get('chat_id') or 0)
+        return self.ok(self.make_message(chat_id, params.get('text', ''), int(params.get('message_id') or 0)))
+
+    async def answer_callback_query(self, params):
+        return self.ok(True)
+
+    async def get_updates(self, params):
+        if self.webhook:
+            return self.error(409, "Conflict: can't use getUpdates method while webhook is active")
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.ok(self.updates[:limit])
+
+    async def set_webhook(self, params):
+        self.webhook = {'url': params['url'], 'secret_token': params.get('secret_token')}
+        return self.ok(True)
+
+    async def delete_webhook(self, params):
+        self.webhook = None
+        return self.ok(True)
+
+    # === کنترل تست ===
+    async def control_updates(self, request: web.Request):
+        body = await request.json()
+        updates = body if isinstance(body, list) else [body]
+        for update in updates:
+            if 'update_id' not in update:
+                self.update_id += 1
+                update['update_id'] = self.update_id
+            if self.webhook:
+                await self.deliver(update)
+            else:
+                self.updates.append(update)
+        self.new_updates.set()
+        return web.json_response({'ok': True, 'queued': len(updates)})
+
+    async def deliver(self, update: dict):
+        """ارسال آپدیت به webhook ثبت‌شده (مثل سرور تلگرام)"""
+        headers = {}
+        if self.webhook['secret_token']:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.webhook['secret_token']
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.webhook['url'], json=update, headers=headers) as response:
+                self.stats[f"webhook_{response.status}"] += 1
+
+    async def control_stats(self, request: web.Request):
+        return web.json_response(dict(self.stats))
+
+    async def control_reset(self, request: web.Request):
+        self.reset()
+        return web.json_response({'ok': True})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/_control/updates', self.control_updates)
+        app.router.add_get('/_control/stats', self.control_stats)
+        app.router.add_post('/_control/reset', self.control_reset)
+        app.router.add_route('*', '/bot{token}/{method}', self.dispatch)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0, help='تأخیر میانگین هر پاسخ')
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, default=0, help='حداکثر پیام در ثانیه (0 = نامحدود)')
+    parser.add_argument('--flood-ratio', type=float, default=0, help='احتمال 429 تصادفی')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--blocked', default='', help='آیدی کاربران بلاک‌کرده (با کاما)')
+    parser.add_argument('--blocked-ratio', type=float, default=0, help='نسبت کاربران بلاک‌کرده')
+    args = parser.parse_args()
+
+    api = FakeBotAPI(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        flood_ratio=args.flood_ratio,
+        retry_after=args.retry_after,
+        blocked=[int(x) for x in args.blocked.split(',') if x.strip()],
+        blocked_ratio=args.blocked_ratio
+    )
+    web.run_app(api.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()